@@ -0,0 +1,72 @@
+"""
+Settings for running the timbrel test suite against SQLite:
+
+    DJANGO_SETTINGS_MODULE=tests.settings python -m django test timbrel
+"""
+
+SECRET_KEY = "timbrel-tests"
+DEBUG = False
+USE_TZ = True
+ROOT_URLCONF = "tests.urls"
+DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+INSTALLED_APPS = [
+    "django.contrib.auth",
+    "django.contrib.contenttypes",
+    "django.contrib.sessions",
+    "rest_framework",
+    "django_filters",
+    "simple_history",
+    "phonenumber_field",
+    "cities_light",
+    "timbrel",
+]
+
+MIDDLEWARE = [
+    "django.contrib.sessions.middleware.SessionMiddleware",
+    "django.contrib.auth.middleware.AuthenticationMiddleware",
+    "simple_history.middleware.HistoryRequestMiddleware",
+]
+
+DATABASES = {
+    "default": {
+        "ENGINE": "tests.sqlite",
+        "NAME": ":memory:",
+    }
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
+AUTH_USER_MODEL = "timbrel.User"
+
+REST_FRAMEWORK = {
+    "DEFAULT_FILTER_BACKENDS": [
+        "django_filters.rest_framework.DjangoFilterBackend",
+    ],
+}
+
+CELERY_TASK_ALWAYS_EAGER = True
+
+MY_APPS = ["timbrel"]
+APP_VERSION = 1
+APP_URL = "http://testserver"
+OTP_EXPIRY = 5
+OTP_MAX_TRIES = 3
+TEST_PHONES = ""
+UPDATE_LAST_LOGIN = False
+
+GOOGLE_MAPS_API_KEY = "AIzaTimbrelTestKey"
+AFRICASTALKING_USERNAME = "sandbox"
+AFRICASTALKING_API_KEY = "timbrel-tests"
+
+MPESA_CONSUMER_KEY = "timbrel-tests"
+MPESA_CONSUMER_SECRET = "timbrel-tests"
+MPESA_SHORTCODE = "174379"
+MPESA_PASSKEY = "timbrel-tests"
+MPESA_OAUTH_ENDPOINT = "http://mpesa.invalid/oauth"
+MPESA_STK_ENDPOINT = "http://mpesa.invalid/stkpush"
+MPESA_CALLBACK_URL = "http://testserver/mpesa/callback"
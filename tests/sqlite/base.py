@@ -0,0 +1,19 @@
+"""
+SQLite backend for the test suite. The models declare CharFields without a
+max_length, which only PostgreSQL supports, so they are created as plain
+varchar columns here.
+"""
+
+from django.db.backends.sqlite3 import base, features
+
+
+class DatabaseFeatures(features.DatabaseFeatures):
+    supports_unlimited_charfield = True
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    features_class = DatabaseFeatures
+    data_types = {
+        **base.DatabaseWrapper.data_types,
+        "CharField": "varchar",
+    }
@@ -0,0 +1,7 @@
+from django.urls import include, path
+
+from timbrel.urls import router
+
+urlpatterns = [
+    path("api/v1/", include(router.urls)),
+]
@@ -87,7 +87,7 @@ class OTP(models.Model):
     )
 
     def save(self, *args, **kwargs):
-        if self.id is None or not self.__class__.objects.filter(pk=self.pk).exists():
+        if self._state.adding:
             active_otp = self.__class__.objects.filter(
                 user=self.user, status="active"
             ).first()
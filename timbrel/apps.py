@@ -3,10 +3,32 @@ from cities_light.apps import CitiesLightConfig
 
 
 class TimbrelConfig(AppConfig):
+    default = True
     default_auto_field = "django.db.models.BigAutoField"
     name = "timbrel"
     label = "timbrel"
 
+    def ready(self):
+        from django.apps import apps
+        from django.core.signals import setting_changed
+        from django.db.models.signals import m2m_changed, post_delete, post_save
+        from django.utils.autoreload import file_changed
+
+        from .base import build_model_descriptors
+        from .geo import invalidate_store_index
+        from .uicopy.models import invalidate_page_snapshots
+        from .utils import clear_serializer_registry
+
+        setting_changed.connect(clear_serializer_registry)
+        file_changed.connect(clear_serializer_registry)
+        post_save.connect(invalidate_store_index)
+        post_delete.connect(invalidate_store_index)
+        post_save.connect(invalidate_page_snapshots)
+        post_delete.connect(invalidate_page_snapshots)
+        m2m_changed.connect(invalidate_page_snapshots)
+
+        build_model_descriptors(apps.get_models())
+
 
 class CustomCitiesLightConfig(CitiesLightConfig):
     verbose_name = "Location"
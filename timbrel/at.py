@@ -1,12 +1,61 @@
-import africastalking
 from django.conf import settings
 
+from .httpclient import http_client
+
+
+class SMS:
+    """
+    Africa's Talking SMS client sending through the shared http_client, with
+    the same `send` signature as `africastalking.SMS`.
+    """
+
+    def __init__(self, username, api_key):
+        self.username = username
+        self.api_key = api_key
+
+    @property
+    def endpoint(self):
+        domain = (
+            "api.sandbox.africastalking.com"
+            if self.username == "sandbox"
+            else "api.africastalking.com"
+        )
+        return f"https://{domain}/version1/messaging"
+
+    def send(self, message, recipients, sender_id=None, enqueue=False, callback=None):
+        data = {
+            "username": self.username,
+            "to": ",".join(recipients),
+            "message": message,
+        }
+        if sender_id:
+            data["from"] = sender_id
+        if enqueue:
+            data["enqueue"] = 1
+
+        try:
+            response = http_client.post(
+                self.endpoint,
+                data=data,
+                headers={"apiKey": self.api_key, "Accept": "application/json"},
+            )
+            response.raise_for_status()
+            result = response.json()
+        except Exception as error:
+            if callback is None:
+                raise
+            callback(error, None)
+            return None
+
+        if callback is not None:
+            callback(None, result)
+        return result
+
 
 username = settings.AFRICASTALKING_USERNAME
 api_key = settings.AFRICASTALKING_API_KEY
-africastalking.initialize(username, api_key)
 
-sms = africastalking.SMS
+sms = SMS(username, api_key)
 
 
 def on_finish(error, response):
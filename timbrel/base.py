@@ -1,3 +1,7 @@
+import functools
+import hashlib
+import operator
+import random
 import uuid
 import inflect
 
@@ -16,12 +20,97 @@ from django.db.models import (
 )
 from django.core.exceptions import FieldDoesNotExist
 from django.conf import settings
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
 from rest_framework import viewsets, serializers
-from simple_history.models import HistoricalRecords
+from rest_framework.response import Response
+
+from .history import PolicyHistoricalRecords
 
 p = inflect.engine()
 
 
+def get_unique_value(model, field_name, value):
+    """
+    Returns `value`, or `value-<n>` with the lowest free suffix, reading
+    every taken value that starts with `value` in a single query.
+    """
+    return get_unique_values(model, field_name, [value])[0]
+
+
+def get_unique_values(model, field_name, values, taken=()):
+    """
+    Makes every value in `values` unique, against the table, the `taken`
+    values and each other, with a single query for the taken values sharing
+    their prefixes.
+    """
+    prefixes = set(values)
+    if not prefixes:
+        return []
+
+    taken = set(taken) | set(
+        model._default_manager.filter(
+            functools.reduce(
+                operator.or_,
+                [
+                    models.Q(**{f"{field_name}__startswith": prefix})
+                    for prefix in prefixes
+                ],
+            )
+        ).values_list(field_name, flat=True)
+    )
+
+    unique_values = []
+    for value in values:
+        unique_value = value
+        count = 1
+        while unique_value in taken:
+            unique_value = f"{value}-{count}"
+            count += 1
+        taken.add(unique_value)
+        unique_values.append(unique_value)
+    return unique_values
+
+
+class CommonQuerySet(models.QuerySet):
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = list(objs)
+        self.allocate_slugs(objs)
+        return super().bulk_create(objs, *args, **kwargs)
+
+    def allocate_slugs(self, objs, batch_size=1000):
+        """
+        Gives the objects that were not assigned a slug the same unique slug
+        `save` would, with one query per `batch_size` objects. The slugs set
+        explicitly on the other objects count as taken.
+        """
+        explicit_slugs = {
+            obj.slug for obj in objs if not isinstance(obj.slug, uuid.UUID)
+        }
+        objs = [
+            obj
+            for obj in objs
+            if obj._state.adding and isinstance(obj.slug, uuid.UUID)
+        ]
+
+        for start in range(0, len(objs), batch_size):
+            batch = []
+            for obj in objs[start : start + batch_size]:
+                source = getattr(obj, obj.get_slug_source(), None)
+                if not source:
+                    source = getattr(obj, obj.get_slug_alt_source(), None)
+                if source:
+                    batch.append((obj, slugify(source)))
+
+            slugs = get_unique_values(
+                self.model, "slug", [slug for _, slug in batch], explicit_slugs
+            )
+            for (obj, _), slug in zip(batch, slugs):
+                obj.slug = slug
+
+        return objs
+
+
 class CommonModel(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     slug = models.SlugField(
@@ -33,6 +122,23 @@ class CommonModel(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     deleted_at = models.DateTimeField(null=True, blank=True)
 
+    objects = CommonQuerySet.as_manager()
+
+    # When saves write a historical record: "all", "off", "status" (creation
+    # and changes of `history_status_field`) or "sampled" (creation and
+    # `history_sample_rate` of the updates).
+    history_policy = "all"
+    history_status_field = None
+    history_sample_rate = 1.0
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if cls.history_status_field in field_names:
+            index = field_names.index(cls.history_status_field)
+            instance._loaded_status = values[index]
+        return instance
+
     def get_absolute_url(self):
         model_name = self.__class__.__name__.lower()
         try:
@@ -73,6 +179,23 @@ class CommonModel(models.Model):
         """
         return ["id"]
 
+    def should_record_history(self, created):
+        """
+        Returns whether this save should write a historical record, following
+        `history_policy`. This can be overridden by a child models as needed.
+        """
+        if self.history_policy == "off":
+            return False
+        if created or self.history_policy == "all":
+            return True
+        if self.history_policy == "status":
+            return getattr(self, "_loaded_status", None) != getattr(
+                self, self.history_status_field
+            )
+        if self.history_policy == "sampled":
+            return random.random() < self.history_sample_rate
+        return True
+
     def meta_to_exclude_from_representation(self):
         return [
             "id",
@@ -85,7 +208,7 @@ class CommonModel(models.Model):
         ]
 
     def save(self, *args, **kwargs):
-        if self.id is None or not self.__class__.objects.filter(pk=self.pk).exists():
+        if self._state.adding:
             source = getattr(self, self.get_slug_source(), None)
             if not source:
                 source = getattr(self, self.get_slug_alt_source(), None)
@@ -95,13 +218,11 @@ class CommonModel(models.Model):
 
         super().save(*args, **kwargs)
 
-    def _ensure_unique_slug(self):
-        original_slug = self.slug
-        count = 1
+        if self.history_status_field:
+            self._loaded_status = getattr(self, self.history_status_field)
 
-        while self.__class__.objects.filter(slug=self.slug).exists():
-            self.slug = f"{original_slug}-{count}"
-            count += 1
+    def _ensure_unique_slug(self):
+        self.slug = get_unique_value(self.__class__, "slug", self.slug)
 
     class Meta:
         abstract = True
@@ -112,32 +233,184 @@ class BaseModel(CommonModel):
     tags = models.ManyToManyField("timbrel.Tag", blank=True)
     facetvalues = models.ManyToManyField("timbrel.FacetValue", blank=True)
     files = models.ManyToManyField("timbrel.File", blank=True)
-    history = HistoricalRecords(inherit=True)
+    history = PolicyHistoricalRecords(inherit=True)
 
     class Meta:
         abstract = True
         ordering = ["-created_at"]
 
 
+class RelationshipDescriptor:
+    """
+    Serialization metadata of a single relationship field, computed once so
+    that BaseSerializer does not call inflect or walk the through model's
+    fields for every row.
+    """
+
+    def __init__(self, field):
+        self.field = field
+        self.name = field.name
+
+        singular_name = p.singular_noun(field.name)
+        self.is_plural = bool(singular_name)
+        self.singular_name = singular_name if singular_name else field.name
+
+        self.through_model = None
+        self.through_fields = []
+
+        if isinstance(field, ManyToManyField):
+            through_model = field.remote_field.through
+            if through_model and not through_model._meta.auto_created:
+                self.through_model = through_model
+                self.through_fields = get_through_fields(through_model)
+
+
+class ModelDescriptor:
+    """
+    Serialization metadata of a model: its relationship fields and the
+    fields to exclude from or include in its representation.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.relationships = {
+            field.name: RelationshipDescriptor(field)
+            for field in model._meta.get_fields()
+            if isinstance(field, (ForeignKey, OneToOneField, ManyToManyField))
+        }
+        self.exclude_from_representation = (
+            model.exclude_from_representation(model)
+            if hasattr(model, "exclude_from_representation")
+            else []
+        )
+        self.include_in_representation = (
+            model.include_in_representation(model)
+            if hasattr(model, "include_in_representation")
+            else []
+        )
+
+
+def get_through_fields(through_model):
+    """
+    Returns the non relationship fields of a through model that are shown
+    as `meta` on the related objects.
+    """
+    if not hasattr(through_model, "meta_to_exclude_from_representation"):
+        return []
+
+    meta_to_exclude = through_model.meta_to_exclude_from_representation(through_model)
+    return [
+        f.name
+        for f in through_model._meta.get_fields()
+        if not isinstance(
+            f,
+            (
+                ForeignKey,
+                ManyToManyField,
+                OneToOneField,
+                ManyToOneRel,
+                OneToOneRel,
+                ManyToManyRel,
+            ),
+        )
+        and f.name not in meta_to_exclude
+    ]
+
+
+model_descriptors = {}
+
+
+def get_model_descriptor(model):
+    descriptor = model_descriptors.get(model)
+    if descriptor is None:
+        descriptor = model_descriptors[model] = ModelDescriptor(model)
+    return descriptor
+
+
+def build_model_descriptors(models):
+    """Precomputes the descriptors of `models`, called when the app is ready."""
+    for model in models:
+        model_descriptors[model] = ModelDescriptor(model)
+
+
+def get_through_attr(field_name):
+    return f"_{field_name}_through"
+
+
+def get_with_lookups(model, withs, prefix="", depth=1):
+    """
+    Returns the select_related and prefetch_related lookups needed to expand
+    the `withs` relationships of `model`. Relationships of the related models
+    are followed `depth` levels deep, since nested serializers share the same
+    `with` param.
+    """
+    select_lookups = []
+    prefetch_lookups = []
+
+    for field_name in dict.fromkeys(withs):
+        try:
+            field = model._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            continue
+
+        if not isinstance(field, (ForeignKey, OneToOneField, ManyToManyField)):
+            continue
+
+        lookup = f"{prefix}{field_name}"
+
+        if isinstance(field, ManyToManyField):
+            prefetch_lookups.append(lookup)
+            through_model = field.remote_field.through
+            if not through_model._meta.auto_created:
+                source_field = through_model._meta.get_field(field.m2m_field_name())
+                prefetch_lookups.append(
+                    models.Prefetch(
+                        f"{prefix}{source_field.remote_field.get_accessor_name()}",
+                        queryset=through_model.objects.all(),
+                        to_attr=get_through_attr(field_name),
+                    )
+                )
+        else:
+            select_lookups.append(lookup)
+
+        if depth > 0:
+            nested_select, nested_prefetch = get_with_lookups(
+                field.related_model, withs, f"{lookup}__", depth - 1
+            )
+            if isinstance(field, ManyToManyField):
+                prefetch_lookups += nested_select + nested_prefetch
+            else:
+                select_lookups += nested_select
+                prefetch_lookups += nested_prefetch
+
+    return select_lookups, prefetch_lookups
+
+
 class BaseSerializer(serializers.ModelSerializer):
     absolute_url = serializers.SerializerMethodField(read_only=True)
     relative_url = serializers.SerializerMethodField(read_only=True)
 
-    def to_representation(self, instance):
-        from .utils import is_relationship, get_serializer_dict
+    @property
+    def _readable_fields(self):
+        """
+        Skips the relationship fields that are not requested through `with`.
+        to_representation drops them anyway, and reading every row's many
+        related primary keys would cost a query per row and field.
+        """
+        descriptor = get_model_descriptor(self.Meta.model)
+        withs = self.get_withs()
+        for field in super()._readable_fields:
+            if field.field_name in descriptor.relationships and (
+                field.field_name not in withs
+            ):
+                continue
+            yield field
 
-        withs = []
+    def to_representation(self, instance):
+        from .utils import serializer_registry
 
-        if "request" in self.context:
-            request = self.context["request"]
-            query_params = request.query_params
-            with_query_params = query_params.get("with", None)
-            if with_query_params:
-                withs += with_query_params.split(",")
-
-        with_context = self.context.get("with", None)
-        if with_context:
-            withs += with_context.split(",")
+        withs = self.get_withs()
+        descriptor = get_model_descriptor(instance.__class__)
 
         """
         Modify the serialized data representation.
@@ -145,35 +418,19 @@ class BaseSerializer(serializers.ModelSerializer):
         data = super().to_representation(instance)  # Get the default representation.
 
         # remove fields from exclude_from_representation
-        for field in instance.exclude_from_representation():
+        for field in descriptor.exclude_from_representation:
             data.pop(field, None)
 
         # add fields from include_in_representation
-        for field in instance.include_in_representation():
+        for field in descriptor.include_in_representation:
             data[field] = getattr(instance, field)
 
-        serializer_dict = get_serializer_dict()
-
-        # TODO: Kigathi - November 28 2024 - Optimize the below for loop
-
-        model_class = instance.__class__
         for field_name in list(data.keys()):
-            if is_relationship(model_class, field_name):
+            relationship = descriptor.relationships.get(field_name)
+            if relationship:
                 data.pop(field_name, None)
                 if withs and field_name in withs:
-                    field = model_class._meta.get_field(field_name)
-                    model_name_lower = model_class.__name__.lower()
-
-                    through_model = None
-
-                    if isinstance(field, ManyToManyField):
-                        if (
-                            field.remote_field.through
-                            and not field.remote_field.through._meta.auto_created
-                        ):
-                            through_model = field.remote_field.through
-
-                    is_plural = p.singular_noun(field_name)
+                    is_plural = relationship.is_plural
 
                     related_objects = (
                         getattr(instance, field_name).all()
@@ -181,10 +438,9 @@ class BaseSerializer(serializers.ModelSerializer):
                         else getattr(instance, field_name)
                     )
 
-                    singular_field = (
-                        p.singular_noun(field_name) if is_plural else field_name
+                    serializer_class = serializer_registry.get(
+                        relationship.singular_name
                     )
-                    serializer_class = serializer_dict.get(singular_field)
                     if serializer_class:
                         related_data = serializer_class(
                             related_objects,
@@ -192,44 +448,17 @@ class BaseSerializer(serializers.ModelSerializer):
                             context=self.context,
                         ).data
                         #: TODO: Kigathi - November 28 2024 - Add a query_param `meta` to optionally include this meta data
-                        if is_plural and through_model:
+                        if is_plural and relationship.through_model:
+                            through_rows = self.get_through_rows(
+                                instance, relationship.field
+                            )
                             for data_item in related_data:
-                                filter_conditions = {
-                                    singular_field: data_item["id"],
-                                    model_name_lower: instance,
-                                }
-                                through_data = through_model.objects.filter(
-                                    **filter_conditions
-                                ).first()
+                                through_data = through_rows.get(data_item.get("id"))
                                 if through_data:
-                                    through_data_dict = {
-                                        f.name: getattr(through_data, f.name)
-                                        for f in through_model._meta.get_fields()
-                                        if (
-                                            not isinstance(
-                                                f,
-                                                (
-                                                    ForeignKey,
-                                                    ManyToManyField,
-                                                    OneToOneField,
-                                                    ManyToOneRel,
-                                                    OneToOneRel,
-                                                    ManyToManyRel,
-                                                ),
-                                            )
-                                            and (
-                                                hasattr(
-                                                    through_model,
-                                                    "meta_to_exclude_from_representation",
-                                                )
-                                                and f.name
-                                                not in through_model.meta_to_exclude_from_representation(
-                                                    through_model
-                                                )
-                                            )
-                                        )  # Exclude relationship fields
+                                    data_item["meta"] = {
+                                        field: getattr(through_data, field)
+                                        for field in relationship.through_fields
                                     }
-                                    data_item["meta"] = through_data_dict
                         data[field_name] = related_data
 
         # remove field if is null or empty array or empty string
@@ -239,6 +468,51 @@ class BaseSerializer(serializers.ModelSerializer):
 
         return data
 
+    def get_withs(self):
+        """
+        Returns the relationships requested through the `with` query param
+        and the `with` context, parsed once per serializer.
+        """
+        if hasattr(self, "_withs"):
+            return self._withs
+
+        withs = []
+
+        if "request" in self.context:
+            request = self.context["request"]
+            query_params = request.query_params
+            with_query_params = query_params.get("with", None)
+            if with_query_params:
+                withs += with_query_params.split(",")
+
+        with_context = self.context.get("with", None)
+        if with_context:
+            withs += with_context.split(",")
+
+        self._withs = withs
+        return withs
+
+    def get_through_rows(self, instance, field):
+        """
+        Returns the through model rows of a many-to-many `field` keyed by the
+        related object's id. Uses the rows prefetched by
+        `BaseViewSet.prefetch_withs` when available, otherwise fetches all of
+        the instance's rows in a single query.
+        """
+        through_model = field.remote_field.through
+        target_field = through_model._meta.get_field(field.m2m_reverse_field_name())
+
+        through_rows = getattr(instance, get_through_attr(field.name), None)
+        if through_rows is None:
+            through_rows = through_model.objects.filter(
+                **{field.m2m_field_name(): instance}
+            )
+
+        rows = {}
+        for through_row in through_rows:
+            rows.setdefault(getattr(through_row, target_field.attname), through_row)
+        return rows
+
     def get_absolute_url(self, obj):
         if hasattr(obj, "get_absolute_url") and callable(
             getattr(obj, "get_absolute_url")
@@ -255,9 +529,109 @@ class BaseSerializer(serializers.ModelSerializer):
 
 
 class BaseViewSet(viewsets.ModelViewSet):
+    prefetch_actions = ["list", "retrieve"]
+    conditional_actions = ["list", "retrieve"]
+
+    def list(self, request, *args, **kwargs):
+        if not self.is_conditional():
+            return super().list(request, *args, **kwargs)
+
+        # Count catches deletions, which leave the latest updated_at unchanged
+        state = (
+            self.filter_queryset(self.get_queryset())
+            .order_by()
+            .aggregate(
+                last_modified=models.Max("updated_at"), count=models.Count("pk")
+            )
+        )
+        etag = self.get_etag(state["last_modified"], state["count"])
+
+        not_modified = self.get_not_modified(request, etag)
+        if not_modified is not None:
+            return not_modified
+
+        response = super().list(request, *args, **kwargs)
+        response["ETag"] = etag
+        return response
+
+    def retrieve(self, request, *args, **kwargs):
+        if not self.is_conditional():
+            return super().retrieve(request, *args, **kwargs)
+
+        instance = self.get_object()
+        etag = self.get_etag(instance.pk, instance.updated_at)
+        last_modified = int(instance.updated_at.timestamp())
+
+        not_modified = self.get_not_modified(request, etag, last_modified)
+        if not_modified is not None:
+            return not_modified
+
+        response = Response(self.get_serializer(instance).data)
+        response["ETag"] = etag
+        response["Last-Modified"] = http_date(last_modified)
+        return response
+
+    def is_conditional(self):
+        # Related rows requested with `with`, and the links to them, change
+        # without touching the rows' updated_at
+        if self.get_withs():
+            return False
+        try:
+            self.queryset.model._meta.get_field("updated_at")
+        except FieldDoesNotExist:
+            return False
+        return self.action in self.conditional_actions
+
+    def get_etag_parts(self):
+        """
+        Returns what, besides the rows' updated_at, the response depends on.
+        This can be overridden by child viewsets as needed.
+        """
+        return [
+            self.request.get_full_path(),
+            self.request.accepted_media_type,
+            self.request.user.pk,
+        ]
+
+    def get_etag(self, *parts):
+        digest = hashlib.md5(
+            repr([*parts, *self.get_etag_parts()]).encode(), usedforsecurity=False
+        ).hexdigest()
+        return f'W/"{digest}"'
+
+    def get_not_modified(self, request, etag, last_modified=None):
+        """
+        Returns a 304 response if the client's copy is current, else None.
+        """
+        response = get_conditional_response(
+            request, etag=etag, last_modified=last_modified
+        )
+        if response is not None:
+            response["ETag"] = etag
+        return response
+
+    def get_withs(self):
+        with_query_params = self.request.query_params.get("with", None)
+        if not with_query_params:
+            return []
+        return with_query_params.split(",")
+
+    def prefetch_withs(self, queryset, withs):
+        """
+        Translates the `with` relationships into select_related and
+        prefetch_related lookups so that BaseSerializer reads them from the
+        prefetch cache instead of querying per instance.
+        """
+        select_lookups, prefetch_lookups = get_with_lookups(queryset.model, withs)
+
+        if select_lookups:
+            queryset = queryset.select_related(*select_lookups)
+        if prefetch_lookups:
+            queryset = queryset.prefetch_related(*prefetch_lookups)
+        return queryset
 
     def get_queryset(self):
-        queryset = self.queryset
+        queryset = self.queryset.all()
         query_params = self.request.query_params
 
         for param, value in query_params.items():
@@ -283,6 +657,9 @@ class BaseViewSet(viewsets.ModelViewSet):
                         except AttributeError:
                             continue
 
+        if self.action in self.prefetch_actions:
+            queryset = self.prefetch_withs(queryset, self.get_withs())
+
         return queryset
 
 
@@ -1,9 +1,9 @@
 from django.db import models
 from django.utils import timezone
 from django.utils import timezone
-from simple_history.models import HistoricalRecords
 
 from timbrel.base import CommonModel, BaseModel
+from timbrel.history import PolicyHistoricalRecords
 
 from timbrel.uicopy.models import (
     Text,
@@ -26,7 +26,7 @@ class Tag(BaseModel):
 class Facet(CommonModel):
     name = models.CharField(unique=True)
     tags = models.ManyToManyField("timbrel.Tag", blank=True)
-    history = HistoricalRecords(inherit=True)
+    history = PolicyHistoricalRecords(inherit=True)
 
     def __str__(self):
         return self.name
@@ -38,7 +38,7 @@ class FacetValue(CommonModel):
         Facet, on_delete=models.CASCADE, related_name="facetvalues"
     )
     tags = models.ManyToManyField("timbrel.Tag", blank=True)
-    history = HistoricalRecords(inherit=True)
+    history = PolicyHistoricalRecords(inherit=True)
 
     def __str__(self):
         return f"{self.facet.name} - {self.name}"
@@ -69,8 +69,9 @@ class FileViewSet(BaseViewSet):
     @action(detail=True, methods=["get"], url_name="view")
     def view(self, request, pk=None):
         file = self.get_object()
+        # A plain update, views are too frequent for a save and history row each
         file.viewed_at = timezone.now()
-        file.save()
+        File.objects.filter(pk=file.pk).update(viewed_at=file.viewed_at)
         if not default_storage.exists(file.path):
             return Response(
                 {"error": "File not found"}, status=status.HTTP_404_NOT_FOUND
@@ -0,0 +1,92 @@
+import math
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .geo import geohash, geohash_center, haversine, to_coordinate
+
+
+class DeliveryPricing:
+    """
+    Prices delivery from the distance between the store and the delivery
+    location. Distances are memoized per store and geohash cell, so repeated
+    checkouts from the same neighbourhood cost a single cache read.
+
+    Subclass it to change the pricing, `get_class(DeliveryPricing)` picks up
+    the first subclass.
+    """
+
+    def __init__(self):
+        # (max distance in km, charge), in increasing order of distance
+        self.bands = getattr(
+            settings,
+            "DELIVERY_CHARGE_BANDS",
+            [(3, 100), (7, 200), (15, 350)],
+        )
+        self.charge_per_km = getattr(settings, "DELIVERY_CHARGE_PER_KM", 30)
+        self.default_charge = getattr(settings, "DELIVERY_DEFAULT_CHARGE", 100)
+        self.precision = getattr(settings, "DELIVERY_GEOHASH_PRECISION", 7)
+        self.timeout = getattr(
+            settings, "DELIVERY_DISTANCE_CACHE_TIMEOUT", 60 * 60 * 24
+        )
+        self.use_distance_matrix = getattr(
+            settings, "DELIVERY_USE_DISTANCE_MATRIX", False
+        )
+
+    def get_charges(self, store, latitude, longitude, delivery_method="delivery"):
+        if delivery_method == "pickup":
+            return Decimal(0)
+
+        distance = self.get_distance(store, latitude, longitude)
+        if distance is None:
+            return Decimal(self.default_charge)
+        return Decimal(self.get_band_charge(distance))
+
+    def get_band_charge(self, distance):
+        for max_distance, charge in self.bands:
+            if distance <= max_distance:
+                return charge
+
+        max_distance, charge = self.bands[-1]
+        return charge + self.charge_per_km * math.ceil(distance - max_distance)
+
+    def get_distance(self, store, latitude, longitude):
+        """
+        Returns the distance in km from the store to the centre of the
+        delivery location's geohash cell, or None if either is not located.
+        """
+        lat, lng = to_coordinate(latitude), to_coordinate(longitude)
+        if store is None or store.lat is None or store.lng is None:
+            return None
+        if lat is None or lng is None:
+            return None
+
+        cell = geohash(lat, lng, self.precision)
+        key = f"delivery_distance:{store.pk}:{cell}"
+        try:
+            distance = cache.get(key)
+        except Exception:
+            distance = None
+
+        if distance is None:
+            distance = self.measure(store, *geohash_center(cell))
+            try:
+                cache.set(key, distance, self.timeout)
+            except Exception:
+                pass
+
+        return distance
+
+    def measure(self, store, lat, lng):
+        distance = haversine(store.lat, store.lng, lat, lng)
+        if not self.use_distance_matrix:
+            return distance
+
+        from .gmaps import get_distance
+
+        try:
+            element = get_distance((store.lat, store.lng), (lat, lng))
+            return element["distance"]["value"] / 1000
+        except Exception:
+            return distance
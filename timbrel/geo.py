@@ -0,0 +1,234 @@
+import heapq
+import math
+import threading
+import uuid
+
+from django.core.cache import cache
+
+EARTH_RADIUS_KM = 6371.0088
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def to_coordinate(value):
+    """
+    Parses a latitude or longitude stored as text, returns None if missing or
+    invalid.
+    """
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    return value if math.isfinite(value) else None
+
+
+def haversine(lat1, lng1, lat2, lng2):
+    """
+    Great circle distance in kilometres between two points.
+    """
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2
+        + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def geohash(lat, lng, precision=7):
+    """
+    Encodes a point as a geohash, the cell is about 150m across at the
+    default precision.
+    """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    bits, bit, even = 0, 0, True
+    cell = []
+
+    while len(cell) < precision:
+        value, value_range = (lng, lng_range) if even else (lat, lat_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        bits <<= 1
+        if value >= middle:
+            bits |= 1
+            value_range[0] = middle
+        else:
+            value_range[1] = middle
+        even = not even
+        bit += 1
+
+        if bit == 5:
+            cell.append(GEOHASH_ALPHABET[bits])
+            bits, bit = 0, 0
+
+    return "".join(cell)
+
+
+def geohash_center(cell):
+    """
+    Returns the (latitude, longitude) at the centre of a geohash cell.
+    """
+    lat_range, lng_range = [-90.0, 90.0], [-180.0, 180.0]
+    even = True
+
+    for char in cell:
+        bits = GEOHASH_ALPHABET.index(char)
+        for shift in range(4, -1, -1):
+            value_range = lng_range if even else lat_range
+            middle = (value_range[0] + value_range[1]) / 2
+            if bits >> shift & 1:
+                value_range[0] = middle
+            else:
+                value_range[1] = middle
+            even = not even
+
+    return (lat_range[0] + lat_range[1]) / 2, (lng_range[0] + lng_range[1]) / 2
+
+
+def to_cartesian(lat, lng):
+    """
+    Projects a point onto the unit sphere, where straight line distances are
+    ordered the same way as great circle distances.
+    """
+    lat, lng = math.radians(lat), math.radians(lng)
+    return (
+        math.cos(lat) * math.cos(lng),
+        math.cos(lat) * math.sin(lng),
+        math.sin(lat),
+    )
+
+
+def chord_to_km(chord):
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, chord / 2))
+
+
+class KDTree:
+    """
+    A static 3-d tree over (point, item) pairs, answering k nearest neighbour
+    queries in logarithmic time.
+    """
+
+    def __init__(self, entries):
+        self.root = self._build(list(entries), 0)
+
+    def _build(self, entries, depth):
+        if not entries:
+            return None
+        axis = depth % 3
+        entries.sort(key=lambda entry: entry[0][axis])
+        median = len(entries) // 2
+        return (
+            entries[median],
+            axis,
+            self._build(entries[:median], depth + 1),
+            self._build(entries[median + 1 :], depth + 1),
+        )
+
+    def nearest(self, point, k=1, predicate=None):
+        """
+        Returns up to `k` (squared distance, item) pairs closest to `point`,
+        nearest first, skipping items for which `predicate` is false.
+        """
+        best = []
+        counter = 0
+
+        def search(node):
+            nonlocal counter
+            if node is None:
+                return
+            (node_point, item), axis, left, right = node
+            distance = sum((a - b) ** 2 for a, b in zip(point, node_point))
+
+            if predicate is None or predicate(item):
+                counter += 1
+                if len(best) < k:
+                    heapq.heappush(best, (-distance, counter, item))
+                elif distance < -best[0][0]:
+                    heapq.heapreplace(best, (-distance, counter, item))
+
+            delta = point[axis] - node_point[axis]
+            near, far = (left, right) if delta < 0 else (right, left)
+            search(near)
+            if len(best) < k or delta**2 < -best[0][0]:
+                search(far)
+
+        search(self.root)
+        return [(-distance, item) for distance, _, item in sorted(best, reverse=True)]
+
+
+class StoreIndex:
+    """
+    Keeps a k-d tree of store coordinates in process. Store changes bump a
+    version in the Django cache, so every worker rebuilds its tree on the next
+    lookup after a store is saved or deleted.
+    """
+
+    version_key = "timbrel:store_index:version"
+
+    def __init__(self):
+        self._tree = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        self._tree = None
+        try:
+            cache.set(self.version_key, uuid.uuid4().hex, None)
+        except Exception:
+            pass
+
+    def get_version(self):
+        try:
+            return cache.get(self.version_key)
+        except Exception:
+            return self._version
+
+    def get_tree(self):
+        version = self.get_version()
+        tree = self._tree
+        if tree is not None and version == self._version:
+            return tree
+
+        with self._lock:
+            if self._tree is None or version != self._version:
+                self._tree = self.build()
+                self._version = version
+            return self._tree
+
+    def build(self):
+        from timbrel.inventory.models import Store
+        from timbrel.utils import get_class
+
+        stores = (
+            get_class(Store)
+            .objects.filter(lat__isnull=False, lng__isnull=False)
+            .values_list("id", "lat", "lng")
+        )
+        return KDTree(
+            (to_cartesian(lat, lng), store_id) for store_id, lat, lng in stores
+        )
+
+    def nearest(self, lat, lng, k=1, store_ids=None):
+        """
+        Returns up to `k` (store id, distance in km) pairs closest to the
+        point, limited to `store_ids` when given.
+        """
+        predicate = None
+        if store_ids is not None:
+            store_ids = set(store_ids)
+            predicate = store_ids.__contains__
+
+        return [
+            (store_id, chord_to_km(math.sqrt(distance)))
+            for distance, store_id in self.get_tree().nearest(
+                to_cartesian(lat, lng), k, predicate
+            )
+        ]
+
+
+store_index = StoreIndex()
+
+
+def invalidate_store_index(sender, **kwargs):
+    """Signal receiver, rebuilds the store index after store changes."""
+    from timbrel.inventory.models import Store
+
+    if issubclass(sender, Store):
+        store_index.invalidate()
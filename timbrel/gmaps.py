@@ -1,36 +1,165 @@
+import hashlib
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
 import googlemaps
 
 from django.conf import settings
+from django.core.cache import cache
 from rest_framework.validators import ValidationError
 
-gmaps = googlemaps.Client(key=settings.GOOGLE_MAPS_API_KEY)
+from .httpclient import http_client
+
+GMAPS_BASE_URL = getattr(
+    settings, "GOOGLE_MAPS_BASE_URL", "https://maps.googleapis.com"
+)
+GMAPS_HOST = urlsplit(GMAPS_BASE_URL).netloc
+
+# Distance Matrix limits per request
+DISTANCE_MATRIX_MAX_ORIGINS = 25
+DISTANCE_MATRIX_MAX_DESTINATIONS = 25
+DISTANCE_MATRIX_MAX_ELEMENTS = 100
+
+gmaps = googlemaps.Client(
+    key=settings.GOOGLE_MAPS_API_KEY,
+    base_url=GMAPS_BASE_URL,
+    connect_timeout=http_client.timeout[0],
+    read_timeout=http_client.timeout[1],
+    requests_session=http_client.session(GMAPS_HOST),
+)
 
 
 def get_distance(origin, destination):
-    return gmaps.distance_matrix(origin, destination)["rows"][0]["elements"][0]
+    with http_client.limit(GMAPS_HOST):
+        return gmaps.distance_matrix(origin, destination)["rows"][0]["elements"][0]
 
 
 def get_directions(origin, destination):
-    return gmaps.directions(origin, destination)
+    with http_client.limit(GMAPS_HOST):
+        return gmaps.directions(origin, destination)
 
 
 def get_elevation(locations):
-    return gmaps.elevation(locations)
+    with http_client.limit(GMAPS_HOST):
+        return gmaps.elevation(locations)
 
 
 def get_geocode(address):
-    return gmaps.geocode(address)
+    with http_client.limit(GMAPS_HOST):
+        return gmaps.geocode(address)
 
 
 def get_reverse_geocode(lat, lng):
-    return gmaps.reverse_geocode((lat, lng))
+    with http_client.limit(GMAPS_HOST):
+        return gmaps.reverse_geocode((lat, lng))
 
 
 def get_place(place_id):
-    return gmaps.place(place_id)
+    with http_client.limit(GMAPS_HOST):
+        return gmaps.place(place_id)
+
+
+def normalize_address(address):
+    return re.sub(r"[\s,]+", " ", str(address)).strip().lower()
+
+
+class GeocodeCache:
+    """
+    Caches geocoded addresses in the Django cache for `timeout` seconds, with
+    a bounded least recently used copy in process in front of it. Addresses
+    are normalized, so that different spellings of the same address share an
+    entry.
+    """
+
+    def __init__(self, prefix="geocode", timeout=60 * 60 * 24 * 30, maxsize=1024):
+        self.prefix = prefix
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.metrics = {"local_hits": 0, "hits": 0, "misses": 0, "errors": 0}
+
+    @property
+    def hit_rate(self):
+        hits = self.metrics["local_hits"] + self.metrics["hits"]
+        lookups = hits + self.metrics["misses"]
+        return hits / lookups if lookups else 0.0
+
+    def key(self, address):
+        digest = hashlib.sha1(normalize_address(address).encode()).hexdigest()
+        return f"{self.prefix}:{digest}"
+
+    def get(self, address):
+        key = self.key(address)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.time():
+                self._entries.move_to_end(key)
+                self.metrics["local_hits"] += 1
+                return entry[0]
+
+        try:
+            result = cache.get(key)
+        except Exception:
+            self.metrics["errors"] += 1
+            result = None
+
+        if result is None:
+            self.metrics["misses"] += 1
+            return None
+
+        self.metrics["hits"] += 1
+        self._remember(key, tuple(result))
+        return tuple(result)
+
+    def set(self, address, result):
+        key = self.key(address)
+        self._remember(key, result)
+
+        try:
+            cache.set(key, result, self.timeout)
+        except Exception:
+            self.metrics["errors"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _remember(self, key, result):
+        with self._lock:
+            self._entries[key] = (result, time.time() + self.timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+geocode_cache = GeocodeCache(
+    timeout=getattr(settings, "GEOCODE_CACHE_TIMEOUT", 60 * 60 * 24 * 30),
+    maxsize=getattr(settings, "GEOCODE_CACHE_MAXSIZE", 1024),
+)
 
 
 def retrieve(string):
+    """
+    Returns the formatted address, latitude and longitude of `string`, from
+    the geocode cache when it has been looked up before.
+    """
+    result = geocode_cache.get(string)
+    if result is None:
+        result = lookup(string)
+        geocode_cache.set(string, result)
+        # The formatted address is what gets stored on the customer, so
+        # looking it up again should not reach Google either.
+        geocode_cache.set(result[0], result)
+    return result
+
+
+def lookup(string):
     geocode = get_geocode(string)
 
     if not geocode:
@@ -49,3 +178,79 @@ def retrieve(string):
         longitude = geocode[0]["geometry"]["location"]["lng"]
 
     return delivery_address, latitude, longitude
+
+
+def get_batch_workers(max_workers=None):
+    return min(
+        max_workers or getattr(settings, "GOOGLE_MAPS_BATCH_WORKERS", 5),
+        http_client.max_concurrency_per_host,
+    )
+
+
+def retrieve_many(addresses, max_workers=None):
+    """
+    Retrieves many addresses concurrently, returning a dict of each address to
+    its (formatted address, latitude, longitude), or None if it could not be
+    geocoded. Cached addresses do not reach Google.
+    """
+    addresses = list(dict.fromkeys(addresses))
+
+    def safe_retrieve(address):
+        try:
+            return retrieve(address)
+        except ValidationError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=get_batch_workers(max_workers)) as executor:
+        return dict(zip(addresses, executor.map(safe_retrieve, addresses)))
+
+
+def chunk(items, size):
+    return [items[i : i + size] for i in range(0, len(items), size)]
+
+
+def get_distance_matrix(origins, destinations, max_workers=None, **kwargs):
+    """
+    Returns the distance matrix elements of every origin to every destination
+    as a list of rows, one per origin, splitting the request into chunks
+    within the Distance Matrix API limits and fetching them concurrently.
+    """
+    origins = list(origins)
+    destinations = list(destinations)
+    if not origins or not destinations:
+        return [[] for _ in origins]
+
+    destinations_per_request = min(
+        len(destinations), DISTANCE_MATRIX_MAX_DESTINATIONS
+    )
+    origins_per_request = min(
+        DISTANCE_MATRIX_MAX_ORIGINS,
+        DISTANCE_MATRIX_MAX_ELEMENTS // destinations_per_request,
+    )
+
+    chunks = [
+        (origin_start, destination_start, origin_chunk, destination_chunk)
+        for origin_start, origin_chunk in zip(
+            range(0, len(origins), origins_per_request),
+            chunk(origins, origins_per_request),
+        )
+        for destination_start, destination_chunk in zip(
+            range(0, len(destinations), destinations_per_request),
+            chunk(destinations, destinations_per_request),
+        )
+    ]
+
+    def fetch(request):
+        _, _, origin_chunk, destination_chunk = request
+        with http_client.limit(GMAPS_HOST):
+            return gmaps.distance_matrix(origin_chunk, destination_chunk, **kwargs)
+
+    matrix = [[None] * len(destinations) for _ in origins]
+    with ThreadPoolExecutor(max_workers=get_batch_workers(max_workers)) as executor:
+        for request, response in zip(chunks, executor.map(fetch, chunks)):
+            origin_start, destination_start, _, _ = request
+            for i, row in enumerate(response["rows"]):
+                for j, element in enumerate(row["elements"]):
+                    matrix[origin_start + i][destination_start + j] = element
+
+    return matrix
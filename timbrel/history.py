@@ -0,0 +1,113 @@
+import threading
+from collections import defaultdict
+from contextlib import ContextDecorator
+
+from django.utils import timezone
+from simple_history.models import HistoricalRecords
+from simple_history.signals import (
+    pre_create_historical_record,
+    post_create_historical_record,
+)
+
+_local = threading.local()
+
+
+def get_history_buffer():
+    return getattr(_local, "buffer", None)
+
+
+class history_batch(ContextDecorator):
+    """
+    Buffers the historical records created inside the block and writes them
+    with one bulk_create per history model when the outermost block exits.
+    Records created in a block that raises are discarded, so use it inside
+    the transaction it belongs to.
+    """
+
+    def __enter__(self):
+        if get_history_buffer() is None:
+            _local.buffer = []
+            _local.marks = []
+        _local.marks.append(len(_local.buffer))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        mark = _local.marks.pop()
+        if exc_type is not None:
+            del _local.buffer[mark:]
+
+        if not _local.marks:
+            buffer, _local.buffer = _local.buffer, None
+            flush_history(buffer)
+        return False
+
+
+def flush_history(buffer):
+    records = defaultdict(list)
+    for record in buffer:
+        records[(record["history_instance"].__class__, record["using"])].append(
+            record
+        )
+
+    for (model, using), model_records in records.items():
+        model.objects.using(using).bulk_create(
+            [record["history_instance"] for record in model_records]
+        )
+        for record in model_records:
+            post_create_historical_record.send(sender=model, **record)
+
+
+class PolicyHistoricalRecords(HistoricalRecords):
+    """
+    HistoricalRecords that asks the instance whether a save is worth a
+    historical record, see CommonModel.should_record_history, and that
+    buffers the records inside a `history_batch`.
+    """
+
+    def post_save(self, instance, created, using=None, **kwargs):
+        should_record_history = getattr(instance, "should_record_history", None)
+        if should_record_history is None or should_record_history(created):
+            super().post_save(instance, created, using=using, **kwargs)
+
+    def post_delete(self, instance, using=None, **kwargs):
+        if getattr(instance, "history_policy", "all") != "off":
+            super().post_delete(instance, using=using, **kwargs)
+
+    def create_historical_record(self, instance, history_type, using=None):
+        buffer = get_history_buffer()
+        manager = getattr(instance, self.manager_name)
+        if buffer is None or manager.model._history_m2m_fields:
+            return super().create_historical_record(instance, history_type, using)
+
+        using = using if self.use_base_model_db else None
+        history_date = getattr(instance, "_history_date", timezone.now())
+        history_user = self.get_history_user(instance)
+        history_change_reason = self.get_change_reason_for_object(
+            instance, history_type, using
+        )
+
+        attrs = {}
+        for field in self.fields_included(instance):
+            attrs[field.attname] = getattr(instance, field.attname)
+
+        if getattr(manager.model, "history_relation", None) is not None:
+            attrs["history_relation"] = instance
+
+        history_instance = manager.model(
+            history_date=history_date,
+            history_type=history_type,
+            history_user=history_user,
+            history_change_reason=history_change_reason,
+            **attrs,
+        )
+
+        record = {
+            "instance": instance,
+            "history_instance": history_instance,
+            "history_date": history_date,
+            "history_user": history_user,
+            "history_change_reason": history_change_reason,
+            "using": using,
+        }
+        pre_create_historical_record.send(sender=manager.model, **record)
+        buffer.append(record)
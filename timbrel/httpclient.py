@@ -0,0 +1,111 @@
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class ConcurrencyLimitExceeded(Exception):
+    pass
+
+
+class HttpClient:
+    """
+    Shared client for outbound integrations (M-Pesa, Google Maps, Africa's
+    Talking). Keeps one pooled keep-alive session per host, bounds every
+    request with connect/read timeouts, retries idempotent requests with
+    backoff and limits the number of concurrent requests per host.
+    """
+
+    def __init__(
+        self,
+        connect_timeout=3.05,
+        read_timeout=30,
+        retries=3,
+        backoff_factor=0.5,
+        pool_maxsize=10,
+        max_concurrency_per_host=10,
+    ):
+        self.timeout = (connect_timeout, read_timeout)
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.pool_maxsize = pool_maxsize
+        self.max_concurrency_per_host = max_concurrency_per_host
+        self._sessions = {}
+        self._semaphores = {}
+        self._lock = threading.Lock()
+
+    def session(self, host):
+        session = self._sessions.get(host)
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(host)
+                if session is None:
+                    session = self._sessions[host] = self._build_session()
+        return session
+
+    def _build_session(self):
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            allowed_methods=Retry.DEFAULT_ALLOWED_METHODS,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.pool_maxsize, max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+
+    @contextmanager
+    def limit(self, host):
+        """
+        Holds one of the host's concurrency slots, raises
+        ConcurrencyLimitExceeded if none frees up within the read timeout.
+        """
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            with self._lock:
+                semaphore = self._semaphores.setdefault(
+                    host, threading.BoundedSemaphore(self.max_concurrency_per_host)
+                )
+
+        if not semaphore.acquire(timeout=self.timeout[1]):
+            raise ConcurrencyLimitExceeded(
+                f"Too many concurrent requests to {host}, try again later."
+            )
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        host = urlsplit(url).netloc
+
+        with self.limit(host):
+            return self.session(host).request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+
+http_client = HttpClient(
+    connect_timeout=getattr(settings, "HTTP_CLIENT_CONNECT_TIMEOUT", 3.05),
+    read_timeout=getattr(settings, "HTTP_CLIENT_READ_TIMEOUT", 30),
+    retries=getattr(settings, "HTTP_CLIENT_RETRIES", 3),
+    backoff_factor=getattr(settings, "HTTP_CLIENT_BACKOFF_FACTOR", 0.5),
+    pool_maxsize=getattr(settings, "HTTP_CLIENT_POOL_MAXSIZE", 10),
+    max_concurrency_per_host=getattr(
+        settings, "HTTP_CLIENT_MAX_CONCURRENCY_PER_HOST", 10
+    ),
+)
@@ -1,6 +1,12 @@
+import datetime
+import functools
+import operator
+
 from django.db import models
+from django.utils import timezone
 
 from timbrel.base import BaseModel
+from timbrel.geo import store_index, to_coordinate
 from timbrel.account.models import User
 
 
@@ -26,11 +32,52 @@ class Store(BaseModel):
     email = models.CharField(max_length=100, blank=True, null=True)
     longitude = models.CharField(max_length=100, blank=True, null=True)
     latitude = models.CharField(max_length=100, blank=True, null=True)
+    lat = models.FloatField(blank=True, null=True, db_index=True, editable=False)
+    lng = models.FloatField(blank=True, null=True, db_index=True, editable=False)
     users = models.ManyToManyField(User, blank=True)
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        self.lat = to_coordinate(self.latitude)
+        self.lng = to_coordinate(self.longitude)
+        super().save(*args, **kwargs)
+
+    @classmethod
+    def nearest(cls, latitude, longitude, quantities=None, k=1):
+        """
+        Returns up to `k` stores closest to the point, nearest first. With
+        `quantities` ({product_id: quantity}), only stores that stock every
+        product in the requested quantity are returned.
+        """
+        lat, lng = to_coordinate(latitude), to_coordinate(longitude)
+        if lat is None or lng is None:
+            return []
+
+        store_ids = None
+        if quantities:
+            store_ids = (
+                StoreProduct.objects.filter(
+                    functools.reduce(
+                        operator.or_,
+                        [
+                            models.Q(product_id=product_id, stock_level__gte=quantity)
+                            for product_id, quantity in quantities.items()
+                        ],
+                    )
+                )
+                .order_by()
+                .values("store_id")
+                .annotate(products=models.Count("product_id", distinct=True))
+                .filter(products=len(quantities))
+                .values_list("store_id", flat=True)
+            )
+
+        nearest = store_index.nearest(lat, lng, k, store_ids)
+        stores = cls.objects.in_bulk([store_id for store_id, _ in nearest])
+        return [stores[store_id] for store_id, _ in nearest if store_id in stores]
+
     def exclude_from_representation(self):
         return [
             "slug",
@@ -90,3 +137,67 @@ class FavoriteProduct(BaseModel):
 
     def __str__(self):
         return f"{self.user.username} - {self.product.name}"
+
+
+class ProductPopularity(models.Model):
+    """
+    Daily confirmed order counts per product, incremented as orders are
+    confirmed so that popular products can be ranked over any window without
+    aggregating all orders.
+    """
+
+    product = models.ForeignKey(
+        Product, on_delete=models.CASCADE, related_name="popularity"
+    )
+    date = models.DateField(db_index=True)
+    order_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = ("product", "date")
+
+    def __str__(self):
+        return f"{self.product.name} - {self.date}: {self.order_count}"
+
+    @classmethod
+    def record(cls, product_counts, date=None):
+        """
+        Adds `product_counts` ({product_id: orders}) to the day's counters
+        with two statements, whatever the number of products.
+        """
+        if not product_counts:
+            return
+
+        date = date or timezone.localdate()
+
+        cls.objects.bulk_create(
+            [cls(product_id=product_id, date=date) for product_id in product_counts],
+            ignore_conflicts=True,
+        )
+        cls.objects.filter(date=date, product_id__in=product_counts.keys()).update(
+            order_count=models.F("order_count")
+            + models.Case(
+                *[
+                    models.When(product_id=product_id, then=models.Value(count))
+                    for product_id, count in product_counts.items()
+                ],
+                default=models.Value(0),
+            )
+        )
+
+    @classmethod
+    def ranking(cls, days=None):
+        """
+        Returns the product ids ordered by confirmed orders, over the last
+        `days` days or all time.
+        """
+        counters = cls.objects.all()
+        if days:
+            counters = counters.filter(
+                date__gt=timezone.localdate() - datetime.timedelta(days=days)
+            )
+        return (
+            counters.values("product_id")
+            .annotate(total_orders=models.Sum("order_count"))
+            .order_by("-total_orders")
+            .values_list("product_id", flat=True)
+        )
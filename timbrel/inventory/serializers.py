@@ -23,13 +23,23 @@ class ProductSerializer(BaseSerializer):
         fields = "__all__"
 
     def get_is_favorite(self, obj):
+        if hasattr(obj, "is_favorite"):
+            return True if obj.is_favorite else None
+
         request = self.context.get("request")
         if request and request.user.is_authenticated:
-            return (
-                True
-                if FavoriteProduct.objects.filter(
-                    user=request.user, product=obj
-                ).exists()
-                else None
-            )
+            return True if obj.id in self.get_favorite_product_ids(request) else None
         return None
+
+    def get_favorite_product_ids(self, request):
+        """
+        Returns the ids of the user's favorite products, fetched once per
+        request and shared with nested serializers through the context.
+        """
+        if "favorite_product_ids" not in self.context:
+            self.context["favorite_product_ids"] = set(
+                FavoriteProduct.objects.filter(user=request.user).values_list(
+                    "product_id", flat=True
+                )
+            )
+        return self.context["favorite_product_ids"]
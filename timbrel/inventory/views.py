@@ -1,3 +1,4 @@
+from django.db.models import Count, Exists, Max, OuterRef
 from rest_framework import permissions
 from rest_framework.response import Response
 from rest_framework.decorators import action
@@ -41,6 +42,35 @@ class ProductViewSet(BaseViewSet):
         "slug",
     ]
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+
+        if (
+            self.action in self.prefetch_actions
+            and self.request.user
+            and self.request.user.is_authenticated
+        ):
+            queryset = queryset.annotate(
+                is_favorite=Exists(
+                    FavoriteProduct.objects.filter(
+                        user=self.request.user, product=OuterRef("pk")
+                    )
+                )
+            )
+
+        return queryset
+
+    def get_etag_parts(self):
+        parts = super().get_etag_parts()
+        if self.request.user and self.request.user.is_authenticated:
+            # is_favorite changes without touching the products
+            parts.append(
+                FavoriteProduct.objects.filter(user=self.request.user).aggregate(
+                    Max("updated_at"), Count("pk")
+                )
+            )
+        return parts
+
     @action(detail=True, methods=["get"])
     def favorite(self, request, pk=None):
         user = request.user
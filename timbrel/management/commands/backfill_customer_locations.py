@@ -0,0 +1,59 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from timbrel.utils import command_log
+from timbrel.gmaps import retrieve_many
+from timbrel.payment.models import Customer
+
+
+class Command(BaseCommand):
+    help = "Geocodes customer addresses that have no latitude or longitude."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--workers", type=int, default=None)
+
+    def handle(self, *args, **kwargs):
+        batch_size = kwargs["batch_size"]
+        customers = (
+            Customer.objects.exclude(Q(address__isnull=True) | Q(address=""))
+            .filter(
+                Q(latitude__isnull=True)
+                | Q(latitude="")
+                | Q(longitude__isnull=True)
+                | Q(longitude="")
+            )
+            .only("id", "address", "latitude", "longitude")
+            .order_by("id")
+        )
+
+        updated = failed = 0
+        last_id = None
+        while True:
+            batch = customers.filter(id__gt=last_id) if last_id else customers
+            batch = list(batch[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            locations = retrieve_many(
+                [customer.address for customer in batch], kwargs["workers"]
+            )
+
+            geocoded = []
+            for customer in batch:
+                location = locations.get(customer.address)
+                if location is None:
+                    failed += 1
+                    continue
+                _, customer.latitude, customer.longitude = location
+                geocoded.append(customer)
+
+            Customer.objects.bulk_update(geocoded, ["latitude", "longitude"])
+            updated += len(geocoded)
+
+        command_log(
+            self,
+            f"Geocoded {updated} customers, {failed} addresses could not be found",
+            "success",
+        )
@@ -0,0 +1,60 @@
+# Generated by Django 5.1.4 on 2026-10-18 09:12
+
+from decimal import Decimal
+
+from django.db import migrations, models
+
+
+def merge_duplicate_pending_orders(apps, schema_editor):
+    """
+    Keeps the most recently updated pending order of every user with more
+    than one, moving the products and transactions of the older ones into it,
+    so that the constraint can be added.
+    """
+    Order = apps.get_model('timbrel', 'Order')
+    OrderProduct = apps.get_model('timbrel', 'OrderProduct')
+    Transaction = apps.get_model('timbrel', 'Transaction')
+
+    user_ids = (
+        Order.objects.filter(order_status='pending')
+        .values('user_id')
+        .annotate(pending_orders=models.Count('id'))
+        .filter(pending_orders__gt=1)
+        .values_list('user_id', flat=True)
+    )
+    for user_id in list(user_ids):
+        kept, *older = Order.objects.filter(user_id=user_id, order_status='pending').order_by('-updated_at')
+        older_ids = [order.id for order in older]
+
+        lines = {line.product_id: line for line in OrderProduct.objects.filter(order=kept)}
+        for line in OrderProduct.objects.filter(order_id__in=older_ids).order_by('created_at'):
+            if line.product_id in lines:
+                lines[line.product_id].quantity += line.quantity
+                lines[line.product_id].save(update_fields=['quantity'])
+                line.delete()
+            else:
+                line.order = kept
+                line.save(update_fields=['order'])
+                lines[line.product_id] = line
+
+        Transaction.objects.filter(order_id__in=older_ids).update(order=kept)
+        kept.total_amount = sum(
+            (Decimal(str(line.price)) * line.quantity for line in lines.values()), Decimal(0)
+        )
+        kept.save(update_fields=['total_amount'])
+        Order.objects.filter(id__in=older_ids).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timbrel', '0006_alter_customer_user'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_pending_orders, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='order',
+            constraint=models.UniqueConstraint(condition=models.Q(('order_status', 'pending')), fields=('user',), name='unique_pending_order_per_user'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.1.4 on 2026-10-18 10:05
+
+import uuid
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timbrel', '0007_order_unique_pending_order_per_user'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MpesaCallback',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('slug', models.SlugField(default=uuid.uuid4, editable=False, max_length=200, unique=True)),
+                ('description', models.TextField(blank=True, null=True)),
+                ('url', models.URLField(blank=True, max_length=255, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('deleted_at', models.DateTimeField(blank=True, null=True)),
+                ('merchant_request_id', models.CharField(blank=True, db_index=True, max_length=100, null=True)),
+                ('checkout_request_id', models.CharField(blank=True, db_index=True, max_length=100, null=True)),
+                ('result_code', models.IntegerField(blank=True, null=True)),
+                ('payload', models.JSONField()),
+                ('callback_status', models.CharField(choices=[('unmatched', 'unmatched'), ('processed', 'processed')], default='unmatched')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+                'abstract': False,
+            },
+        ),
+        migrations.AddField(
+            model_name='historicaltransaction',
+            name='checkout_reference',
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+        migrations.AddField(
+            model_name='transaction',
+            name='checkout_reference',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='historicaltransaction',
+            name='reference',
+            field=models.CharField(blank=True, db_index=True, max_length=100, null=True),
+        ),
+        migrations.AlterField(
+            model_name='transaction',
+            name='reference',
+            field=models.CharField(blank=True, max_length=100, null=True, unique=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.1.4 on 2026-10-18 11:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timbrel', '0008_transaction_checkout_reference_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='historicalorder',
+            name='order_status',
+            field=models.CharField(choices=[('pending', 'pending'), ('processing', 'processing'), ('confirmed', 'confirmed'), ('shipped', 'shipped'), ('delivered', 'delivered')], default='pending'),
+        ),
+        migrations.AlterField(
+            model_name='mpesacallback',
+            name='callback_status',
+            field=models.CharField(choices=[('queued', 'queued'), ('unmatched', 'unmatched'), ('processed', 'processed')], default='unmatched'),
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='order_status',
+            field=models.CharField(choices=[('pending', 'pending'), ('processing', 'processing'), ('confirmed', 'confirmed'), ('shipped', 'shipped'), ('delivered', 'delivered')], default='pending'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.4 on 2026-10-18 12:02
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models.functions import TruncDate
+
+
+def backfill_product_popularity(apps, schema_editor):
+    OrderProduct = apps.get_model('timbrel', 'OrderProduct')
+    ProductPopularity = apps.get_model('timbrel', 'ProductPopularity')
+
+    counts = (
+        OrderProduct.objects.filter(order__order_status__in=['confirmed', 'shipped', 'delivered'])
+        .annotate(date=TruncDate('order__created_at'))
+        .values('product_id', 'date')
+        .annotate(order_count=models.Count('order_id', distinct=True))
+    )
+    ProductPopularity.objects.bulk_create(
+        [ProductPopularity(**count) for count in counts.iterator()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timbrel', '0009_alter_order_order_status_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductPopularity',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(db_index=True)),
+                ('order_count', models.PositiveIntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='popularity', to='timbrel.product')),
+            ],
+            options={
+                'unique_together': {('product', 'date')},
+            },
+        ),
+        migrations.RunPython(backfill_product_popularity, migrations.RunPython.noop),
+    ]
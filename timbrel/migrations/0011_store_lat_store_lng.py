@@ -0,0 +1,47 @@
+# Generated by Django 5.1.4 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+def backfill_store_coordinates(apps, schema_editor):
+    Store = apps.get_model('timbrel', 'Store')
+
+    stores = []
+    for store in Store.objects.exclude(latitude__isnull=True).exclude(longitude__isnull=True).iterator():
+        try:
+            store.lat, store.lng = float(store.latitude), float(store.longitude)
+        except ValueError:
+            continue
+        stores.append(store)
+    Store.objects.bulk_update(stores, ['lat', 'lng'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('timbrel', '0010_productpopularity'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalstore',
+            name='lat',
+            field=models.FloatField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='historicalstore',
+            name='lng',
+            field=models.FloatField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='store',
+            name='lat',
+            field=models.FloatField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='store',
+            name='lng',
+            field=models.FloatField(blank=True, db_index=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_store_coordinates, migrations.RunPython.noop),
+    ]
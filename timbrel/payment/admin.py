@@ -4,7 +4,7 @@ from unfold.decorators import display
 
 from timbrel.admin import BaseAdmin
 
-from .models import Order, Transaction, Coupon
+from .models import Order, Transaction, Coupon, MpesaCallback
 from .inlines import OrderProductsInline
 
 
@@ -58,6 +58,7 @@ class OrderAdmin(BaseAdmin):
         description=_("Status"),
         label={
             "pending": "info",
+            "processing": "info",
             "confirmed": "primary",
             "shipped": "warning",
             "delivered": "success",
@@ -102,6 +103,50 @@ class TransactionAdmin(BaseAdmin):
     search_fields = ["reference"]
 
 
+@admin.register(MpesaCallback)
+class MpesaCallbackAdmin(BaseAdmin):
+    fields = (
+        ("merchant_request_id", "checkout_request_id"),
+        ("result_code", "callback_status"),
+        "payload",
+    )
+    list_display = (
+        "merchant_request_id",
+        "checkout_request_id",
+        "result_code",
+        "callback_status",
+        "created_at",
+    )
+    readonly_fields = [
+        "merchant_request_id",
+        "checkout_request_id",
+        "result_code",
+        "callback_status",
+        "payload",
+    ]
+    list_filter = ["callback_status"]
+    search_fields = ["merchant_request_id", "checkout_request_id"]
+
+    actions = ["reprocess_callbacks"]
+
+    def reprocess_callbacks(self, request, queryset):
+        """
+        Retry unmatched callbacks, e.g. after the missing transaction was recorded.
+        """
+        callbacks = MpesaCallback.process(
+            list(queryset.filter(callback_status="unmatched"))
+        )
+        MpesaCallback.objects.bulk_update(callbacks, ["callback_status"])
+        processed = len(
+            [
+                callback
+                for callback in callbacks
+                if callback.callback_status == "processed"
+            ]
+        )
+        self.message_user(request, f"{processed} callbacks have been processed.")
+
+
 @admin.register(Coupon)
 class CouponAdmin(BaseAdmin):
     fields = [
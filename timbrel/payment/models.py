@@ -1,17 +1,23 @@
+import json
 import uuid
 import datetime
 
+from django.conf import settings
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db import models, transaction
 from django.utils import timezone
 from phonenumber_field.phonenumber import PhoneNumber
+from simple_history.utils import bulk_update_with_history
 
-from timbrel.base import BaseModel
+from timbrel.base import CommonModel, BaseModel, get_unique_value
 from timbrel.account.models import User
-from timbrel.inventory.models import Store, Product, StoreProduct
+from timbrel.inventory.models import Store, Product, StoreProduct, ProductPopularity
 from timbrel.utils import mpesa_express, generate_random_string
 from timbrel.gmaps import retrieve
 
+MPESA_CALLBACK_DRAIN_KEY = "timbrel:mpesa:callbacks:drain"
+
 
 class Customer(BaseModel):
     BILLING_CYCLES = (
@@ -153,10 +159,13 @@ class Order(BaseModel):
     )
     ORDER_STATUS = (
         ("pending", "pending"),
+        ("processing", "processing"),
         ("confirmed", "confirmed"),
         ("shipped", "shipped"),
         ("delivered", "delivered"),
     )
+    # Statuses of the orders counted in ProductPopularity
+    CONFIRMED_STATUSES = ("confirmed", "shipped", "delivered")
     DELIVERY_METHODS = (
         ("pickup", "pickup"),
         ("delivery", "delivery"),
@@ -187,6 +196,20 @@ class Order(BaseModel):
     )
     custom_discount = models.DecimalField(max_digits=10, decimal_places=2, null=True)
 
+    # Cart total updates are not recorded, only the status changes
+    history_policy = "status"
+    history_status_field = "order_status"
+
+    class Meta:
+        ordering = ["-created_at"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["user"],
+                condition=models.Q(order_status="pending"),
+                name="unique_pending_order_per_user",
+            )
+        ]
+
     def __str__(self):
         return self.reference
 
@@ -194,20 +217,85 @@ class Order(BaseModel):
         return "reference"
 
     def save(self, *args, **kwargs):
-        if self.id is None or not self.__class__.objects.filter(pk=self.pk).exists():
+        if self._state.adding:
             reference = generate_random_string(3)
             date_part = datetime.datetime.now().strftime("%y%m%d")
-            reference_number = f"ORD-{date_part}-{reference.upper()}"
-            self.reference = reference_number
-            count = 1
-            while self.__class__.objects.filter(reference=self.reference).exists():
-                self.reference = f"{self.reference}-{count}"
-                count += 1
-            self.reference = self.reference.upper()
+            self.reference = get_unique_value(
+                self.__class__, "reference", f"ORD-{date_part}-{reference.upper()}"
+            )
 
-        super().save(*args, **kwargs)
+        confirming = (
+            self.order_status in self.CONFIRMED_STATUSES
+            and getattr(self, "_loaded_status", None) not in self.CONFIRMED_STATUSES
+        )
+        with transaction.atomic():
+            if confirming and not self._state.adding:
+                # Locks the row so that concurrent saves count the order once
+                confirming = not (
+                    self.__class__.objects.select_for_update()
+                    .filter(pk=self.pk, order_status__in=self.CONFIRMED_STATUSES)
+                    .exists()
+                )
+
+            super().save(*args, **kwargs)
+
+            if confirming:
+                self.record_popularity([self])
+
+    @staticmethod
+    def record_popularity(orders):
+        """
+        Counts the products of newly confirmed `orders` in ProductPopularity
+        and schedules the popular products recompute.
+        """
+        from timbrel.tasks import schedule_popular_products
+
+        ProductPopularity.record(
+            dict(
+                OrderProduct.objects.filter(order__in=orders)
+                .values("product_id")
+                .annotate(order_count=models.Count("order_id", distinct=True))
+                .values_list("product_id", "order_count")
+            )
+        )
+        transaction.on_commit(schedule_popular_products)
 
     def pay(self, payment_details=None):
+        phone = self.prepare_payment(payment_details)
+        self.push_payment(phone)
+        return True
+
+    def pay_async(self, payment_details=None):
+        """
+        Records a pending transaction and leaves the STK push to the
+        `process_payment` task, so the request does not wait on the upstream.
+        Poll the transaction for the payment status.
+        """
+        from timbrel.tasks import process_payment
+
+        payment_method, created = PaymentMethod.objects.get_or_create(name="mpesa")
+
+        with transaction.atomic():
+            # Locks the order so a concurrent payment sees it as processing,
+            # and the cart can no longer change the amount being charged
+            order = self.__class__.objects.select_for_update().get(pk=self.pk)
+            phone = order.prepare_payment(payment_details)
+
+            order.order_status = "processing"
+            order.save()
+
+            payment = Transaction.objects.create(
+                payment_method=payment_method,
+                amount=order.total_amount,
+                user=order.user,
+                order=order,
+            )
+            process_payment.delay_on_commit(str(payment.id), phone)
+
+        self.refresh_from_db()
+        return payment
+
+    def prepare_payment(self, payment_details=None):
         if self.order_status != "pending":
             raise ValueError("Only pending orders can be paid.")
 
@@ -223,6 +311,15 @@ class Order(BaseModel):
 
         self.apply_coupon()
 
+        return phone
+
+    def push_payment(self, phone, payment=None):
+        """
+        Sends the STK push and marks the order as processing until the M-Pesa
+        callback confirms it, recording the response on `payment` or on a new
+        transaction.
+        """
+
         # TODO: Kigathi - December 20 2024 - Response depends on the payment method
 
         response = mpesa_express(
@@ -233,22 +330,33 @@ class Order(BaseModel):
         )
 
         if "errorCode" in response:
+            if payment:
+                payment.transaction_status = "failed"
+                payment.save()
             raise ValueError(response["errorMessage"])
 
         with transaction.atomic():
-            self.order_status = "confirmed"
+            self.order_status = "processing"
             self.save()
 
-            payment_method, created = PaymentMethod.objects.get_or_create(name="mpesa")
-            Transaction.objects.create(
-                payment_method=payment_method,
-                amount=self.total_amount,
-                user=self.user,
-                order=self,
-                reference=response["MerchantRequestID"],
-            )
+            if payment:
+                payment.reference = response["MerchantRequestID"]
+                payment.checkout_reference = response.get("CheckoutRequestID")
+                payment.save()
+            else:
+                payment_method, created = PaymentMethod.objects.get_or_create(
+                    name="mpesa"
+                )
+                payment = Transaction.objects.create(
+                    payment_method=payment_method,
+                    amount=self.total_amount,
+                    user=self.user,
+                    order=self,
+                    reference=response["MerchantRequestID"],
+                    checkout_reference=response.get("CheckoutRequestID"),
+                )
 
-        return True
+        return payment
 
     def apply_coupon(self):
         if self.coupon and self.coupon.is_valid() and not self.coupon_applied:
@@ -272,6 +380,9 @@ class OrderProduct(BaseModel):
     quantity = models.IntegerField(default=1)
     price = models.FloatField(default=0)
 
+    # Cart lines change on every cart click, the order keeps the audit trail
+    history_policy = "off"
+
     def __str__(self):
         return f"{self.order.reference} - {self.product.name}"
 
@@ -295,7 +406,209 @@ class Transaction(BaseModel):
     balance = models.FloatField(default=0)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     order = models.ForeignKey(Order, on_delete=models.CASCADE, null=True, blank=True)
-    reference = models.CharField(max_length=100, null=True, blank=True)
+    reference = models.CharField(max_length=100, null=True, blank=True, unique=True)
+    checkout_reference = models.CharField(
+        max_length=100, null=True, blank=True, unique=True
+    )
+
+    history_policy = "status"
+    history_status_field = "transaction_status"
+
+
+class MpesaCallback(CommonModel):
+    """
+    M-Pesa STK push callbacks. Queued callbacks are waiting for the
+    `process_mpesa_callbacks` task, and unmatched ones are the dead letters
+    of callbacks that did not match any transaction. The periodic
+    `sweep_mpesa_callbacks` task drains the queue if a drain was lost and
+    prunes old processed callbacks.
+    """
+
+    CALLBACK_STATUS = (
+        ("queued", "queued"),
+        ("unmatched", "unmatched"),
+        ("processed", "processed"),
+    )
+    merchant_request_id = models.CharField(
+        max_length=100, null=True, blank=True, db_index=True
+    )
+    checkout_request_id = models.CharField(
+        max_length=100, null=True, blank=True, db_index=True
+    )
+    result_code = models.IntegerField(null=True, blank=True)
+    payload = models.JSONField()
+    callback_status = models.CharField(choices=CALLBACK_STATUS, default="unmatched")
+
+    def __str__(self):
+        return self.merchant_request_id or self.checkout_request_id or str(self.id)
+
+    @classmethod
+    def from_payload(cls, payload, **kwargs):
+        stk_callback = payload.get("Body", {}).get("stkCallback", {})
+        return cls(
+            merchant_request_id=stk_callback.get("MerchantRequestID", None),
+            checkout_request_id=stk_callback.get("CheckoutRequestID", None),
+            result_code=stk_callback.get("ResultCode", None),
+            payload=payload,
+            **kwargs,
+        )
+
+    @classmethod
+    def handle(cls, payload):
+        """
+        Processes a single callback right away, keeping it only if it did not
+        match a transaction.
+        """
+        callback = cls.from_payload(payload)
+        cls.process([callback])
+
+        if callback.callback_status == "unmatched":
+            # Safaricom retries callbacks, keep a single dead letter for them
+            callback, _ = cls.objects.get_or_create(
+                merchant_request_id=callback.merchant_request_id,
+                checkout_request_id=callback.checkout_request_id,
+                defaults={
+                    "result_code": callback.result_code,
+                    "payload": callback.payload,
+                    "callback_status": "unmatched",
+                },
+            )
+        return callback
+
+    @classmethod
+    def enqueue(cls, payload):
+        """
+        Appends the callback to the queue and schedules a drain, coalescing
+        the callbacks received within MPESA_CALLBACK_BATCH_DELAY seconds into
+        one `process_mpesa_callbacks` run.
+        """
+        from timbrel.tasks import process_mpesa_callbacks
+
+        callback = cls.from_payload(payload, callback_status="queued")
+        callback.save()
+
+        delay = getattr(settings, "MPESA_CALLBACK_BATCH_DELAY", 2)
+        if cache.add(MPESA_CALLBACK_DRAIN_KEY, True, delay * 10):
+            transaction.on_commit(
+                lambda: process_mpesa_callbacks.apply_async(countdown=delay)
+            )
+        return callback
+
+    @classmethod
+    def process(cls, callbacks):
+        """
+        Applies a batch of callbacks with a handful of bulk statements: one
+        locking lookup of the matching transactions, one update per
+        transaction status and per order transition, with their historical
+        records written in bulk. Callbacks for transactions that are no
+        longer pending are duplicates and only marked as processed.
+        """
+        merchant_request_ids = [
+            callback.merchant_request_id
+            for callback in callbacks
+            if callback.merchant_request_id
+        ]
+        checkout_request_ids = [
+            callback.checkout_request_id
+            for callback in callbacks
+            if callback.checkout_request_id
+        ]
+
+        with transaction.atomic():
+            # Duplicate callbacks processed concurrently wait on the lock and
+            # then see the transaction as no longer pending
+            payments = Transaction.objects.select_for_update().filter(
+                models.Q(reference__in=merchant_request_ids)
+                | models.Q(checkout_reference__in=checkout_request_ids)
+            )
+            by_reference = {}
+            for payment in payments:
+                if payment.reference:
+                    by_reference[("merchant", payment.reference)] = payment
+                if payment.checkout_reference:
+                    by_reference[("checkout", payment.checkout_reference)] = payment
+
+            results = {"success": {}, "failed": {}}
+            for callback in callbacks:
+                payment = by_reference.get(
+                    ("merchant", callback.merchant_request_id)
+                ) or by_reference.get(("checkout", callback.checkout_request_id))
+
+                if not payment:
+                    callback.callback_status = "unmatched"
+                    continue
+
+                callback.callback_status = "processed"
+                if payment.transaction_status != "pending":
+                    continue
+
+                # Later callbacks of the batch for the same transaction are
+                # duplicates, it is no longer pending
+                result = "success" if callback.result_code == 0 else "failed"
+                results[result][payment.id] = payment
+                payment.transaction_status = result
+                payment.description = json.dumps(callback.payload)
+
+            now = timezone.now()
+            payments = [*results["success"].values(), *results["failed"].values()]
+            for payment in payments:
+                payment.updated_at = now
+            if payments:
+                bulk_update_with_history(
+                    payments,
+                    Transaction,
+                    ["transaction_status", "description", "updated_at"],
+                    default_date=now,
+                )
+
+            confirmed_orders = [
+                payment.order_id
+                for payment in results["success"].values()
+                if payment.order_id
+            ]
+            failed_orders = [
+                payment.order_id
+                for payment in results["failed"].values()
+                if payment.order_id
+            ]
+
+            if confirmed_orders:
+                confirmed_orders = list(
+                    Order.objects.select_for_update().filter(
+                        id__in=confirmed_orders,
+                        order_status__in=["pending", "processing"],
+                    )
+                )
+
+            if confirmed_orders:
+                cls.transition_orders(confirmed_orders, "confirmed", now)
+                Order.record_popularity(confirmed_orders)
+
+            if failed_orders:
+                # Failed orders can be paid again, unless the user already
+                # started a new cart, since a user has only one pending order
+                failed_orders = list(
+                    Order.objects.select_for_update()
+                    .filter(id__in=failed_orders, order_status="processing")
+                    .exclude(
+                        user__in=Order.objects.filter(order_status="pending").values(
+                            "user"
+                        )
+                    )
+                )
+                cls.transition_orders(failed_orders, "pending", now)
+
+        return callbacks
+
+    @staticmethod
+    def transition_orders(orders, order_status, now):
+        for order in orders:
+            order.order_status = order_status
+            order.updated_at = now
+        if orders:
+            bulk_update_with_history(
+                orders, Order, ["order_status", "updated_at"], default_date=now
+            )
 
 
 class PaymentMethod(BaseModel):
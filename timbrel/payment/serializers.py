@@ -1,9 +1,16 @@
 import uuid
 
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import F, FloatField, Sum
+from django.utils import timezone
 from rest_framework import serializers
 from rest_framework.exceptions import ValidationError
+from simple_history.utils import bulk_create_with_history
 
 from timbrel.base import BaseSerializer
+from timbrel.delivery import DeliveryPricing
+from timbrel.history import history_batch
 from timbrel.account.serializers import UserSerializer
 from timbrel.inventory.models import Product, Store
 from timbrel.utils import get_class, only_pop
@@ -171,12 +178,44 @@ class OrderSerializer(BaseSerializer):
 
         products = validated_data.pop("orderproducts")
 
+        if not validated_data.get("store"):
+            validated_data["store"] = self.get_nearest_store(
+                customer_profile, products
+            )
+
+        validated_data["delivery_charges"] = get_class(DeliveryPricing)().get_charges(
+            validated_data["store"],
+            customer_profile.latitude,
+            customer_profile.longitude,
+            validated_data.get("delivery_method", "delivery"),
+        )
+
         order = self.cart(validated_data, products, True)
 
-        order.pay()
+        if getattr(settings, "ASYNC_PAYMENTS", False):
+            order.pay_async()
+        else:
+            order.pay()
 
         return order
 
+    def get_nearest_store(self, customer_profile, products):
+        """
+        Returns the store closest to the delivery location that has every
+        ordered product in stock, or None.
+        """
+        quantities = {}
+        for product in products:
+            product_id = str(product["product"])
+            quantities[product_id] = quantities.get(product_id, 0) + product.get(
+                "quantity", 1
+            )
+
+        stores = get_class(Store).nearest(
+            customer_profile.latitude, customer_profile.longitude, quantities
+        )
+        return stores[0] if stores else None
+
     def before_new_cart(self, operation, product, quantity):
         pass
 
@@ -197,7 +236,6 @@ class OrderSerializer(BaseSerializer):
         quantity = validated_data.pop("quantity", 1)
         operation = validated_data.pop("operation", "add")
         product = validated_data.pop("products", product)
-        product_model = get_class(Product)
         order_model = get_class(Order)
 
         if isinstance(product, list):
@@ -211,52 +249,115 @@ class OrderSerializer(BaseSerializer):
         else:
             product_ids = [(product, quantity)]
 
-        products = product_model.objects.filter(
-            id__in=[item[0] for item in product_ids]
-        )
+        quantities = {}
+        for product_id, product_quantity in product_ids:
+            try:
+                product_id = str(uuid.UUID(str(product_id)))
+            except ValueError:
+                raise serializers.ValidationError(
+                    f"Invalid UUID format for 'product': {product_id}."
+                )
+            quantities[product_id] = quantities.get(product_id, 0) + product_quantity
 
-        for product_id, quantity in product_ids:
-            product_instance = products.get(id=product_id)
-            self.before_new_cart(operation, product_instance, quantity)
+        with transaction.atomic(), history_batch():
+            products = self.get_cart_products(quantities.keys())
 
-        pending_order = order_model.objects.filter(
-            user=validated_data["user"], order_status="pending"
-        ).first()
+            for product_id, product_quantity in quantities.items():
+                self.before_new_cart(operation, products[product_id], product_quantity)
 
-        if not pending_order:
-            if operation == "remove":
-                raise serializers.ValidationError(
-                    "You cannot remove a product from an order that does not exist."
-                )
+            pending_order = self.get_pending_order(validated_data["user"])
+
+            if not pending_order:
+                if operation == "remove":
+                    raise serializers.ValidationError(
+                        "You cannot remove a product from an order that does not exist."
+                    )
+
+                try:
+                    with transaction.atomic():
+                        order = order_model.objects.create(**validated_data)
+                except IntegrityError:
+                    # A concurrent request created the user's pending order first
+                    pending_order = self.get_pending_order(validated_data["user"])
+                    if not pending_order:
+                        raise
+                else:
+                    self.update_cart(order, products, quantities, operation, {})
+                    order.total_amount = self.get_cart_total(order)
+                    order.save()
+                    return order
+
+            orderproducts = {
+                str(orderproduct.product_id): orderproduct
+                for orderproduct in get_class(OrderProduct)
+                .objects.select_for_update()
+                .filter(order=pending_order, product_id__in=quantities.keys())
+            }
+            self.update_cart(
+                pending_order, products, quantities, operation, orderproducts
+            )
+
+            pending_order.total_amount = self.get_cart_total(pending_order)
 
-            order = order_model.objects.create(**validated_data)
-
-            for product_id, product_quantity in product_ids:
-                product_instance = product_model.objects.get(id=product_id)
-                orderproduct, _ = get_class(OrderProduct).objects.update_or_create(
-                    order=order,
-                    product=product_instance,
-                    quantity=product_quantity,
-                    price=(
-                        product_instance.offer_price
-                        if product_instance.offer
-                        else product_instance.price
-                    ),
+            if checkout:
+                pending_order.store = validated_data.get("store")
+                pending_order.delivery_charges = validated_data.get(
+                    "delivery_charges", pending_order.delivery_charges
                 )
 
-            total_amount = sum(
-                (orderproduct.price * orderproduct.quantity)
-                for orderproduct in order.order_products.all()
+            if "coupon" in validated_data and checkout:
+                pending_order.coupon = validated_data["coupon"]
+                pending_order.apply_coupon()
+
+            pending_order.save()
+            return pending_order
+
+    def get_pending_order(self, user):
+        """
+        Returns the user's pending order, locking it so that concurrent cart
+        mutations of the same order are applied one after the other.
+        """
+        return (
+            get_class(Order)
+            .objects.select_for_update()
+            .filter(user=user, order_status="pending")
+            .first()
+        )
+
+    def get_cart_products(self, product_ids):
+        """
+        Loads all the cart products, with their offers, in a single query.
+        """
+        products = {
+            str(product.id): product
+            for product in get_class(Product)
+            .objects.filter(id__in=product_ids)
+            .select_related("offer")
+        }
+
+        missing_products = [
+            product_id for product_id in product_ids if product_id not in products
+        ]
+        if missing_products:
+            raise serializers.ValidationError(
+                f"Products do not exist: {', '.join(missing_products)}."
             )
-            order.total_amount = total_amount
-            order.save()
-            return order
 
-        for product_id, product_quantity in product_ids:
-            product_instance = product_model.objects.get(id=product_id)
-            orderproduct = OrderProduct.objects.filter(
-                order=pending_order, product=product_instance
-            ).first()
+        return products
+
+    def update_cart(self, order, products, quantities, operation, orderproducts):
+        """
+        Applies the cart operation to the order's products, creating, updating
+        and deleting the affected order products in bulk.
+        """
+        orderproduct_model = get_class(OrderProduct)
+        now = timezone.now()
+        new_orderproducts = []
+        updated_orderproducts = []
+
+        for product_id, product_quantity in quantities.items():
+            product_instance = products[product_id]
+            orderproduct = orderproducts.get(product_id)
 
             if not orderproduct:
                 if operation == "remove":
@@ -264,45 +365,66 @@ class OrderSerializer(BaseSerializer):
                         "Product does not exist in the order."
                     )
 
-                orderproduct = OrderProduct.objects.create(
-                    order=pending_order,
-                    product=product_instance,
-                    quantity=product_quantity,
-                    price=(
-                        product_instance.offer_price
-                        if product_instance.offer
-                        else product_instance.price
-                    ),
-                )
-            else:
-                if operation == "add":
-                    self.before_old_cart(
-                        operation, product_instance, orderproduct, product_quantity
+                new_orderproducts.append(
+                    orderproduct_model(
+                        order=order,
+                        product=product_instance,
+                        quantity=product_quantity,
+                        price=(
+                            product_instance.offer_price
+                            if product_instance.offer
+                            else product_instance.price
+                        ),
                     )
+                )
+                continue
 
-                orderproduct.quantity = (
-                    orderproduct.quantity + product_quantity
-                    if operation == "add"
-                    else orderproduct.quantity - product_quantity
+            if operation == "add":
+                self.before_old_cart(
+                    operation, product_instance, orderproduct, product_quantity
                 )
-                orderproduct.save()
 
-            if orderproduct.quantity == 0:
-                orderproduct.delete()
+            quantity_change = (
+                product_quantity if operation == "add" else -product_quantity
+            )
+            orderproduct.quantity += quantity_change
+            orderproduct.updated_at = now
+            updated_orderproducts.append((orderproduct, quantity_change))
 
-        total_amount = sum(
-            (orderproduct.price * orderproduct.quantity)
-            for orderproduct in pending_order.order_products.all()
-        )
+        record_history = orderproduct_model.history_policy != "off"
 
-        pending_order.total_amount = total_amount
+        if new_orderproducts:
+            if record_history:
+                bulk_create_with_history(new_orderproducts, orderproduct_model)
+            else:
+                orderproduct_model.objects.bulk_create(new_orderproducts)
+
+        if updated_orderproducts:
+            # Increment in the database so that writes outside the cart are not lost
+            orderproducts = []
+            for orderproduct, quantity_change in updated_orderproducts:
+                orderproducts.append(orderproduct)
+                orderproduct.new_quantity = orderproduct.quantity
+                orderproduct.quantity = F("quantity") + quantity_change
+            orderproduct_model.objects.bulk_update(
+                orderproducts, ["quantity", "updated_at"]
+            )
+            for orderproduct in orderproducts:
+                orderproduct.quantity = orderproduct.new_quantity
+            if record_history:
+                orderproduct_model.history.bulk_history_create(
+                    orderproducts, update=True
+                )
 
-        if "coupon" in validated_data and checkout:
-            pending_order.coupon = validated_data["coupon"]
-            pending_order.apply_coupon()
+            orderproduct_model.objects.filter(order=order, quantity__lte=0).delete()
 
-        pending_order.save()
-        return pending_order
+    def get_cart_total(self, order):
+        return (
+            order.order_products.aggregate(
+                total_amount=Sum(F("price") * F("quantity"), output_field=FloatField())
+            )["total_amount"]
+            or 0
+        )
 
     def after_cart(self, validated_data):
         pass
@@ -1,5 +1,6 @@
-import json
+import logging
 
+from django.conf import settings
 from rest_framework import status
 from rest_framework import permissions
 from rest_framework.views import APIView
@@ -8,8 +9,14 @@ from rest_framework.decorators import action
 from rest_framework.views import APIView
 
 from .filters import OrderFilter
-from .models import Customer, Order, Transaction, PaymentMethod, Coupon
-from timbrel.tasks import calculate_popular_products
+from .models import (
+    Customer,
+    Order,
+    Transaction,
+    PaymentMethod,
+    Coupon,
+    MpesaCallback,
+)
 
 from timbrel.permissions import IsOwnerOnly
 from timbrel.base import BaseViewSet
@@ -21,6 +28,8 @@ from .serializers import (
     CouponSerializer,
 )
 
+logger = logging.getLogger(__name__)
+
 
 class MpesaCallbackView(APIView):
     permission_classes = (permissions.AllowAny,)
@@ -28,29 +37,20 @@ class MpesaCallbackView(APIView):
     def post(self, request):
         mpesa_callback = request.data
 
-        merchant_request_id = (
-            mpesa_callback.get("Body", {})
-            .get("stkCallback", {})
-            .get("MerchantRequestID", None)
-        )
-        result_code = (
-            mpesa_callback.get("Body", {})
-            .get("stkCallback", {})
-            .get("ResultCode", None)
-        )
+        stk_callback = mpesa_callback.get("Body", {}).get("stkCallback", {})
 
-        if merchant_request_id:
-            try:
-                transaction = Transaction.objects.get(reference=merchant_request_id)
-            except Transaction.DoesNotExist:
-                raise ValueError(
-                    f"No transaction found with reference: {merchant_request_id}"
-                )
-            transaction.transaction_status = "success" if result_code == 0 else "failed"
-            transaction.description = json.dumps(request.data)
-            transaction.save()
+        if stk_callback.get("MerchantRequestID") or stk_callback.get(
+            "CheckoutRequestID"
+        ):
+            if getattr(settings, "MPESA_CALLBACK_QUEUE", False):
+                MpesaCallback.enqueue(mpesa_callback)
+            else:
+                MpesaCallback.handle(mpesa_callback)
         else:
-            print("No merchant request id or result code")
+            logger.warning(
+                "M-Pesa callback without MerchantRequestID or CheckoutRequestID: %s",
+                mpesa_callback,
+            )
 
         return Response(status=status.HTTP_200_OK)
 
@@ -87,7 +87,7 @@ class OrderViewSet(BaseViewSet):
         """
         Override to allow different permissions for register vs other actions.
         """
-        if self.action == "pay" or self.action == "create":
+        if self.action in ["pay", "create"]:
             return [permissions.AllowAny()]
         else:
             return super().get_permissions()
@@ -111,10 +111,22 @@ class OrderViewSet(BaseViewSet):
 
         try:
             payment_details = request.data.get("payment_details")
+
+            if getattr(settings, "ASYNC_PAYMENTS", False):
+                payment = order.pay_async(payment_details=payment_details)
+                return Response(
+                    {
+                        "status": "pending",
+                        "message": "Payment initiated.",
+                        "transaction": payment.id,
+                        "status_url": self.reverse_action("payment", args=[order.pk]),
+                    },
+                    status=status.HTTP_202_ACCEPTED,
+                )
+
             order.pay(payment_details=payment_details)
-            calculate_popular_products.delay_on_commit()
             return Response(
-                {"status": "success", "message": "Order paid successfully."},
+                {"status": "success", "message": "Payment request sent."},
                 status=status.HTTP_200_OK,
             )
 
@@ -131,6 +143,27 @@ class OrderViewSet(BaseViewSet):
                 status=status.HTTP_500_INTERNAL_SERVER_ERROR,
             )
 
+    @action(detail=True, methods=["get"])
+    def payment(self, request, pk=None):
+        order = self.get_object()
+        payment = order.transaction_set.order_by("-created_at").first()
+
+        if not payment:
+            return Response(
+                {"status": "error", "message": "Order has no payment."},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+
+        return Response(
+            {
+                "status": payment.transaction_status,
+                "order_status": order.order_status,
+                "transaction": payment.id,
+                "reference": payment.reference,
+            },
+            status=status.HTTP_200_OK,
+        )
+
 
 class TransactionViewSet(BaseViewSet):
     queryset = Transaction.objects.all()
@@ -1,8 +1,29 @@
-from django.db.models import Count
+import datetime
+
+import requests
+from urllib3.exceptions import NewConnectionError
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
 from celery import shared_task
 
 from .at import sms, on_finish
-from .models import Product, Tag, Facet, FacetValue
+from .httpclient import ConcurrencyLimitExceeded
+from .models import (
+    Order,
+    Product,
+    ProductPopularity,
+    Tag,
+    Facet,
+    FacetValue,
+    Transaction,
+    MpesaCallback,
+)
+from .payment.models import MPESA_CALLBACK_DRAIN_KEY
+
+POPULAR_PRODUCTS_SCHEDULE_KEY = "timbrel:popular_products:scheduled"
 
 
 @shared_task(name="send_sms")
@@ -10,40 +31,193 @@ def send_sms(recipient, message):
     sms.send(message, [recipient], callback=on_finish)
 
 
+def was_not_sent(exc):
+    """
+    True when the request failed before reaching the upstream: the
+    connection was never established or no concurrency slot freed up. Any
+    other connection error may have happened after the request was sent.
+    """
+    if isinstance(exc, (requests.ConnectTimeout, ConcurrencyLimitExceeded)):
+        return True
+    reason = exc.args[0] if exc.args else None
+    return isinstance(getattr(reason, "reason", reason), NewConnectionError)
+
+
+def fail_payment(payment):
+    """
+    Marks the transaction as failed and lets the order be paid again, unless
+    the user already started a new cart.
+    """
+    with transaction.atomic():
+        payment.transaction_status = "failed"
+        payment.save()
+
+        order = (
+            Order.objects.select_for_update()
+            .filter(id=payment.order_id, order_status="processing")
+            .first()
+        )
+        if order and not Order.objects.filter(
+            user_id=order.user_id, order_status="pending"
+        ).exists():
+            order.order_status = "pending"
+            order.save()
+
+
+@shared_task(bind=True, max_retries=getattr(settings, "PAYMENT_MAX_RETRIES", 3))
+def process_payment(self, transaction_id, phone):
+    payment = Transaction.objects.select_related("order", "order__user").get(
+        id=transaction_id
+    )
+
+    if payment.transaction_status != "pending" or payment.reference:
+        return
+
+    in_flight = (
+        Transaction.objects.filter(
+            order_id=payment.order_id, transaction_status="pending"
+        )
+        .exclude(id=payment.id)
+        .exists()
+    )
+    if in_flight:
+        # Another STK push for the order is awaiting its callback
+        payment.transaction_status = "failed"
+        payment.save()
+        return
+
+    try:
+        payment.order.push_payment(phone, payment)
+    except (requests.ConnectionError, ConcurrencyLimitExceeded) as e:
+        # Only requests that never left are retried, a connection dropped
+        # after the STK push was sent could charge the customer twice
+        if not was_not_sent(e) or self.request.retries >= self.max_retries:
+            fail_payment(payment)
+            raise
+        raise self.retry(exc=e, countdown=2**self.request.retries * 5)
+    except Exception:
+        fail_payment(payment)
+        raise
+
+
+@shared_task
+def process_mpesa_callbacks(batch_size=None):
+    """
+    Drains the queued M-Pesa callbacks in batches. Rows are locked with
+    SKIP LOCKED so concurrent drains never process the same callback.
+    """
+    batch_size = batch_size or getattr(settings, "MPESA_CALLBACK_BATCH_SIZE", 500)
+
+    # Callbacks queued from here on schedule a new drain
+    cache.delete(MPESA_CALLBACK_DRAIN_KEY)
+
+    while True:
+        with transaction.atomic():
+            callbacks = list(
+                MpesaCallback.objects.select_for_update(skip_locked=True)
+                .filter(callback_status="queued")
+                .order_by("created_at")[:batch_size]
+            )
+            if not callbacks:
+                return
+
+            MpesaCallback.process(callbacks)
+            MpesaCallback.objects.bulk_update(callbacks, ["callback_status"])
+
+
+@shared_task(name="sweep_mpesa_callbacks")
+def sweep_mpesa_callbacks():
+    """
+    Periodic safety net for the callback queue, schedule it with celery beat.
+    Drains callbacks left queued for more than MPESA_CALLBACK_SWEEP_AGE
+    seconds, whose drain was lost with a rolled back transaction or a worker
+    outage, and prunes processed callbacks older than
+    MPESA_CALLBACK_RETENTION seconds. Unmatched dead letters are kept.
+    """
+    now = timezone.now()
+    sweep_age = getattr(settings, "MPESA_CALLBACK_SWEEP_AGE", 60)
+    retention = getattr(settings, "MPESA_CALLBACK_RETENTION", 7 * 24 * 60 * 60)
+
+    stale = MpesaCallback.objects.filter(
+        callback_status="queued",
+        created_at__lt=now - datetime.timedelta(seconds=sweep_age),
+    )
+    if stale.exists():
+        process_mpesa_callbacks()
+
+    MpesaCallback.objects.filter(
+        callback_status="processed",
+        created_at__lt=now - datetime.timedelta(seconds=retention),
+    ).delete()
+
+
+def schedule_popular_products():
+    """
+    Schedules calculate_popular_products to run in POPULAR_PRODUCTS_INTERVAL
+    seconds, unless a run is already scheduled, so that bursts of confirmed
+    orders trigger a single recompute.
+    """
+    interval = getattr(settings, "POPULAR_PRODUCTS_INTERVAL", 60)
+    if cache.add(POPULAR_PRODUCTS_SCHEDULE_KEY, True, interval):
+        calculate_popular_products.apply_async(countdown=interval)
+
+
 @shared_task
 def calculate_popular_products():
     # TODO: Kigathi - December 17 2024 - Ensure that this function is doing the right thing
 
-    popular_tag, created = Tag.objects.get_or_create(name="Popular")
-
-    if not created:
-        for product in Product.objects.filter(tags=popular_tag):
-            product.tags.remove(popular_tag)
-        for tag in Tag.objects.filter(tags=popular_tag):
-            tag.tags.remove(popular_tag)
+    popular_tag, _ = Tag.objects.get_or_create(name="Popular")
 
-    popular_products = (
-        Product.objects.filter(orders__order_status="confirmed")
-        .annotate(confirmed_order_count=Count("orders"))
-        .order_by("-confirmed_order_count")[:4]
+    popular_products = list(
+        ProductPopularity.ranking(
+            days=getattr(settings, "POPULAR_PRODUCTS_WINDOW_DAYS", None)
+        )[: getattr(settings, "POPULAR_PRODUCTS_COUNT", 4)]
     )
 
-    for product in popular_products:
-        product.tags.add(popular_tag)
+    reassign_tag(Product, popular_tag, popular_products)
+    reassign_tag(Tag, popular_tag, [])
 
     category_facet = Facet.objects.filter(name="Category").first()
     if not category_facet:
         return
 
-    product_facetvalues = FacetValue.objects.filter(
-        id__in=popular_products.values_list("facetvalues__id", flat=True)
-    ).distinct()
-
-    popular_facetvalues = category_facet.facetvalues.filter(
-        id__in=product_facetvalues.values_list("id", flat=True)
-    ).distinct()
+    popular_facetvalues = (
+        Product.facetvalues.through.objects.filter(
+            product_id__in=popular_products, facetvalue__facet=category_facet
+        )
+        .values_list("facetvalue_id", flat=True)
+        .distinct()
+    )
 
-    for facetvalue in popular_facetvalues:
-        facetvalue.tags.add(popular_tag)
+    reassign_tag(FacetValue, popular_tag, popular_facetvalues)
 
     return
+
+
+def reassign_tag(model, tag, object_ids):
+    """
+    Makes `object_ids` the exact set of `model` rows tagged with `tag`,
+    deleting and inserting only the through table rows that change.
+    """
+    field = model._meta.get_field("tags")
+    through = field.remote_field.through
+    source_field = through._meta.get_field(field.m2m_field_name())
+    target_field = through._meta.get_field(field.m2m_reverse_field_name())
+
+    tagged = through.objects.filter(**{target_field.attname: tag.id})
+    current_ids = set(tagged.values_list(source_field.attname, flat=True))
+    object_ids = set(object_ids)
+
+    removed_ids = current_ids - object_ids
+    if removed_ids:
+        tagged.filter(**{f"{source_field.attname}__in": removed_ids}).delete()
+
+    added_ids = object_ids - current_ids
+    if added_ids:
+        through.objects.bulk_create(
+            [
+                through(**{source_field.attname: object_id, target_field.attname: tag.id})
+                for object_id in added_ids
+            ],
+            ignore_conflicts=True,
+        )
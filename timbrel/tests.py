@@ -1,3 +1,1029 @@
-from django.test import TestCase
+"""
+Benchmarks for the BaseSerializer / BaseViewSet list and detail endpoints.
 
-# Create your tests here.
+Every endpoint is measured at each of the BENCHMARK_SIZES, 10 and 100 rows
+by default (run the release sizes with `TIMBREL_BENCHMARK_SIZES=10,100,1000`),
+for latency, peak allocations and SQL queries. The query budget is the
+number of extra queries allowed per extra row, so a serializer change that
+adds an N+1 fails the suite before release.
+Set `TIMBREL_BENCHMARK_VERBOSE=1` to print the results table.
+
+Run against SQLite with the settings in tests/settings.py:
+
+    DJANGO_SETTINGS_MODULE=tests.settings python -m django test timbrel
+"""
+
+import datetime
+import json
+import os
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from rest_framework.exceptions import ValidationError
+from django.utils import timezone
+from django.utils.text import slugify
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from timbrel.account.models import User
+from timbrel.common.models import Tag, Facet, FacetValue
+from timbrel.common.views import TagViewSet, FacetViewSet
+from timbrel.inventory.models import Store, Product, StoreProduct, ProductPopularity
+from timbrel.inventory.views import StoreViewSet, ProductViewSet
+from timbrel.payment.models import (
+    Order,
+    OrderProduct,
+    PaymentMethod,
+    Transaction,
+    MpesaCallback,
+)
+from timbrel.payment.serializers import OrderSerializer
+from timbrel.payment.views import OrderViewSet, MpesaCallbackView
+from timbrel.tasks import sweep_mpesa_callbacks
+from timbrel.utils import (
+    TokenCache,
+    mpesa_express,
+    mpesa_token_cache,
+    request_mpesa_access_token,
+)
+from timbrel.uicopy.models import (
+    Text,
+    Section,
+    SectionText,
+    SectionSection,
+    Data,
+    SectionData,
+    Page,
+    PageSection,
+    get_page_snapshot_version,
+)
+from timbrel.uicopy.views import PageViewSet, SectionViewSet
+
+BENCHMARK_SIZES = [
+    int(size)
+    for size in os.environ.get("TIMBREL_BENCHMARK_SIZES", "10,100").split(",")
+]
+BENCHMARK_REPEAT = int(os.environ.get("TIMBREL_BENCHMARK_REPEAT", 3))
+BENCHMARK_VERBOSE = os.environ.get("TIMBREL_BENCHMARK_VERBOSE", False)
+
+
+class BenchmarkDataGenerator:
+    """
+    Creates deterministic synthetic catalog, order and page data with
+    bulk inserts, so that generating 1000 rows stays cheap.
+    """
+
+    tags_per_row = 2
+    products_per_order = 2
+    texts_per_section = 1
+
+    def __init__(self, user=None):
+        self.user = user
+
+    def tags(self, size, prefix="Tag"):
+        return Tag.objects.bulk_create(
+            [
+                Tag(name=f"{prefix} {i}", slug=slugify(f"{prefix} {i}"))
+                for i in range(size)
+            ]
+        )
+
+    def facets(self, size):
+        facets = Facet.objects.bulk_create(
+            [Facet(name=f"Facet {i}", slug=f"facet-{i}") for i in range(size)]
+        )
+        FacetValue.objects.bulk_create(
+            [
+                FacetValue(name=f"Value {i}", slug=f"facet-{i}-value", facet=facet)
+                for i, facet in enumerate(facets)
+            ]
+        )
+        return facets
+
+    def stores(self, size):
+        return Store.objects.bulk_create(
+            [
+                Store(
+                    name=f"Store {i}",
+                    slug=f"store-{i}",
+                    latitude="-1.2921",
+                    longitude="36.8219",
+                )
+                for i in range(size)
+            ]
+        )
+
+    def products(self, size):
+        products = Product.objects.bulk_create(
+            [
+                Product(
+                    name=f"Product {i}",
+                    slug=f"product-{i}",
+                    price=100 + i,
+                    sku=f"SKU-{i}",
+                    stock_level=i % 10,
+                )
+                for i in range(size)
+            ]
+        )
+
+        tags = self.tags(self.tags_per_row, prefix="Product Tag")
+        Product.tags.through.objects.bulk_create(
+            [
+                Product.tags.through(product_id=product.id, tag_id=tag.id)
+                for product in products
+                for tag in tags
+            ]
+        )
+
+        store = self.stores(1)[0]
+        StoreProduct.objects.bulk_create(
+            [
+                StoreProduct(
+                    store=store,
+                    product=product,
+                    stock_level=product.stock_level,
+                    price=product.price,
+                )
+                for product in products
+            ]
+        )
+        return products
+
+    def orders(self, size):
+        products = self.products(self.products_per_order)
+        orders = Order.objects.bulk_create(
+            [
+                Order(
+                    reference=f"ORD-BENCH-{i}",
+                    slug=f"ord-bench-{i}",
+                    user=self.user,
+                    # A user can only have a single pending order
+                    order_status="confirmed",
+                    total_amount=sum(product.price for product in products),
+                )
+                for i in range(size)
+            ]
+        )
+        OrderProduct.objects.bulk_create(
+            [
+                OrderProduct(
+                    order=order,
+                    product=product,
+                    quantity=1,
+                    price=product.price,
+                )
+                for order in orders
+                for product in products
+            ]
+        )
+        return orders
+
+    def page(self, size):
+        page = Page.objects.create(title="Benchmark Page")
+        sections = Section.objects.bulk_create(
+            [Section(title=f"Section {i}", slug=f"section-{i}") for i in range(size)]
+        )
+        PageSection.objects.bulk_create(
+            [
+                PageSection(page=page, section=section, order=i)
+                for i, section in enumerate(sections)
+            ]
+        )
+        texts = Text.objects.bulk_create(
+            [
+                Text(content=f"Text {i}", slug=f"text-{i}")
+                for i in range(size * self.texts_per_section)
+            ]
+        )
+        SectionText.objects.bulk_create(
+            [
+                SectionText(
+                    section=sections[i // self.texts_per_section], text=text, order=i
+                )
+                for i, text in enumerate(texts)
+            ]
+        )
+        return page
+
+
+class BenchmarkResult:
+    def __init__(self, name, size, queries, seconds, peak_memory):
+        self.name = name
+        self.size = size
+        self.queries = queries
+        self.seconds = seconds
+        self.peak_memory = peak_memory
+
+    def __str__(self):
+        return (
+            f"{self.name:<32} {self.size:>6} rows {self.queries:>6} queries "
+            f"{self.seconds * 1000:>10.2f} ms {self.peak_memory / 1024:>10.1f} KiB"
+        )
+
+
+class BaseBenchmarkTestCase(TestCase):
+    """
+    Subclasses benchmark an endpoint with `run_benchmark`, passing the view,
+    a data generator, a request builder and the allowed `queries_per_row`.
+    """
+
+    factory = APIRequestFactory()
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.results = []
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_superuser(
+            username="benchmark",
+            email="benchmark@example.com",
+            password="benchmark",
+            phone="254700000000",
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        if BENCHMARK_VERBOSE:
+            for result in cls.results:
+                print(result)
+        super().tearDownClass()
+
+    def dispatch(self, view, request, **kwargs):
+        response = view(request, **kwargs)
+        response.render()
+        return response
+
+    def measure(self, name, size, view, request, **kwargs):
+        with CaptureQueriesContext(connection) as context:
+            response = self.dispatch(view, request, **kwargs)
+        self.assertEqual(response.status_code, 200, response.content)
+
+        tracemalloc.start()
+        seconds = None
+        for _ in range(BENCHMARK_REPEAT):
+            start = time.perf_counter()
+            self.dispatch(view, request, **kwargs)
+            elapsed = time.perf_counter() - start
+            seconds = elapsed if seconds is None else min(seconds, elapsed)
+        _, peak_memory = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        result = BenchmarkResult(
+            name, size, len(context.captured_queries), seconds, peak_memory
+        )
+        self.results.append(result)
+        return result
+
+    def run_benchmark(self, name, view, setup_data, get_request, queries_per_row):
+        results = []
+        for size in BENCHMARK_SIZES:
+            with transaction.atomic():
+                data = setup_data(size)
+                request, kwargs = get_request(data)
+                results.append(self.measure(name, size, view, request, **kwargs))
+                transaction.set_rollback(True)
+
+        self.assertQueryBudget(results, queries_per_row)
+        return results
+
+    def assertQueryBudget(self, results, queries_per_row):
+        for previous, current in zip(results, results[1:]):
+            extra_rows = current.size - previous.size
+            extra_queries = current.queries - previous.queries
+            self.assertLessEqual(
+                extra_queries,
+                queries_per_row * extra_rows,
+                f"{current.name}: {extra_queries} extra queries for {extra_rows} "
+                f"extra rows exceeds the budget of {queries_per_row} per row.",
+            )
+
+    def build_request(self, path="/", data=None, authenticated=False):
+        request = self.factory.get(path, data)
+        if authenticated:
+            force_authenticate(request, user=self.user)
+        return request
+
+
+class ProductBenchmarkTest(BaseBenchmarkTestCase):
+    def setUp(self):
+        self.generator = BenchmarkDataGenerator(self.user)
+        self.list_view = ProductViewSet.as_view({"get": "list"}, pagination_class=None)
+        self.detail_view = ProductViewSet.as_view({"get": "retrieve"})
+
+    def test_list(self):
+        # Relationship fields are only read when requested with `with`
+        self.run_benchmark(
+            "products",
+            self.list_view,
+            self.generator.products,
+            lambda products: (self.build_request(), {}),
+            queries_per_row=0,
+        )
+
+    def test_list_authenticated(self):
+        self.run_benchmark(
+            "products (authenticated)",
+            self.list_view,
+            self.generator.products,
+            lambda products: (self.build_request(authenticated=True), {}),
+            queries_per_row=0,
+        )
+
+    def test_list_with_tags(self):
+        self.run_benchmark(
+            "products?with=tags",
+            self.list_view,
+            self.generator.products,
+            lambda products: (self.build_request(data={"with": "tags"}), {}),
+            queries_per_row=0,
+        )
+
+    def test_list_filtered_by_tags(self):
+        self.run_benchmark(
+            "products?tags=",
+            self.list_view,
+            self.generator.products,
+            lambda products: (
+                self.build_request(data={"tags": "Product Tag 0"}),
+                {},
+            ),
+            queries_per_row=0,
+        )
+
+    def test_list_not_modified(self):
+        self.generator.products(10)
+        etag = self.dispatch(self.list_view, self.build_request())["ETag"]
+
+        request = self.factory.get("/", HTTP_IF_NONE_MATCH=etag)
+        with CaptureQueriesContext(connection) as context:
+            response = self.list_view(request)
+
+        # A single aggregate, nothing is serialized
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response["ETag"], etag)
+        self.assertEqual(len(context.captured_queries), 1)
+
+    def test_list_with_is_not_conditional(self):
+        # Adding a tag to a product leaves the product's updated_at unchanged
+        self.generator.products(1)
+        response = self.dispatch(
+            self.list_view, self.build_request(data={"with": "tags"})
+        )
+        self.assertFalse(response.has_header("ETag"))
+
+    def test_detail(self):
+        self.run_benchmark(
+            "product detail",
+            self.detail_view,
+            self.generator.products,
+            lambda products: (self.build_request(), {"pk": products[0].pk}),
+            queries_per_row=0,
+        )
+
+
+class StoreBenchmarkTest(BaseBenchmarkTestCase):
+    def test_list(self):
+        self.run_benchmark(
+            "stores",
+            StoreViewSet.as_view({"get": "list"}, pagination_class=None),
+            BenchmarkDataGenerator(self.user).stores,
+            lambda stores: (self.build_request(), {}),
+            queries_per_row=0,
+        )
+
+
+class TagBenchmarkTest(BaseBenchmarkTestCase):
+    def test_list(self):
+        self.run_benchmark(
+            "tags",
+            TagViewSet.as_view({"get": "list"}, pagination_class=None),
+            BenchmarkDataGenerator(self.user).tags,
+            lambda tags: (self.build_request(), {}),
+            queries_per_row=0,
+        )
+
+
+class FacetBenchmarkTest(BaseBenchmarkTestCase):
+    def test_list(self):
+        self.run_benchmark(
+            "facets",
+            FacetViewSet.as_view({"get": "list"}, pagination_class=None),
+            BenchmarkDataGenerator(self.user).facets,
+            lambda facets: (self.build_request(), {}),
+            queries_per_row=0,
+        )
+
+
+class OrderBenchmarkTest(BaseBenchmarkTestCase):
+    def setUp(self):
+        self.generator = BenchmarkDataGenerator(self.user)
+        self.list_view = OrderViewSet.as_view({"get": "list"}, pagination_class=None)
+        self.detail_view = OrderViewSet.as_view({"get": "retrieve"})
+
+    def test_list(self):
+        self.run_benchmark(
+            "orders",
+            self.list_view,
+            self.generator.orders,
+            lambda orders: (self.build_request(authenticated=True), {}),
+            queries_per_row=0,
+        )
+
+    def test_list_with_products(self):
+        # The products of every order are prefetched in a single query
+        self.run_benchmark(
+            "orders?with=products",
+            self.list_view,
+            self.generator.orders,
+            lambda orders: (
+                self.build_request(data={"with": "products"}, authenticated=True),
+                {},
+            ),
+            queries_per_row=0,
+        )
+
+    def test_detail_with_products(self):
+        self.run_benchmark(
+            "order detail?with=products",
+            self.detail_view,
+            self.generator.orders,
+            lambda orders: (
+                self.build_request(data={"with": "products"}, authenticated=True),
+                {"pk": orders[0].pk},
+            ),
+            queries_per_row=0,
+        )
+
+
+class PageBenchmarkTest(BaseBenchmarkTestCase):
+    def test_detail(self):
+        # Rows are the sections of the page, the snapshot loads them with a
+        # fixed number of queries whatever their number.
+        self.run_benchmark(
+            "page detail",
+            PageViewSet.as_view({"get": "retrieve"}),
+            BenchmarkDataGenerator(self.user).page,
+            lambda page: (self.build_request(), {"pk": page.pk}),
+            queries_per_row=0,
+        )
+
+
+class SectionBenchmarkTest(BaseBenchmarkTestCase):
+    def test_list(self):
+        # One section tree is loaded for the whole list
+        self.run_benchmark(
+            "sections",
+            SectionViewSet.as_view({"get": "list"}, pagination_class=None),
+            BenchmarkDataGenerator(self.user).page,
+            lambda page: (self.build_request(), {}),
+            queries_per_row=0,
+        )
+
+
+class BulkCreateSlugTest(TestCase):
+    def test_explicit_slugs_in_the_batch_are_taken(self):
+        Product.objects.create(name="Hot", price=100, sku="SKU-0")
+        products = Product.objects.bulk_create(
+            [
+                Product(name="Hot", slug="hot-1", price=100, sku="SKU-1"),
+                Product(name="Hot", price=100, sku="SKU-2"),
+            ]
+        )
+
+        self.assertEqual([product.slug for product in products], ["hot-1", "hot-2"])
+
+
+class SectionTreeTest(TestCase):
+    factory = APIRequestFactory()
+
+    def sections(self, size):
+        return [
+            Section.objects.create(title=f"Section {i}", slug=f"section-{i}")
+            for i in range(size)
+        ]
+
+    def link(self, parent, child):
+        SectionSection.objects.create(parent=parent, child=child)
+
+    def retrieve(self, section):
+        response = SectionViewSet.as_view({"get": "retrieve"})(
+            self.factory.get("/"), pk=section.pk
+        )
+        response.render()
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.data
+
+    def get_titles(self, data):
+        """Returns the nested titles, [title, [children...]]."""
+        return [
+            data["title"],
+            [self.get_titles(child) for child in data.get("child_sections", [])],
+        ]
+
+    def test_cycle(self):
+        a, b = self.sections(2)
+        self.link(a, b)
+        self.link(b, a)
+
+        self.assertEqual(
+            self.get_titles(self.retrieve(a)), ["Section 0", [["Section 1", []]]]
+        )
+
+    def test_self_link(self):
+        (a,) = self.sections(1)
+        self.link(a, a)
+
+        self.assertEqual(self.get_titles(self.retrieve(a)), ["Section 0", []])
+
+    @override_settings(SECTION_MAX_DEPTH=2)
+    def test_max_depth(self):
+        sections = self.sections(5)
+        for parent, child in zip(sections, sections[1:]):
+            self.link(parent, child)
+
+        self.assertEqual(
+            self.get_titles(self.retrieve(sections[0])),
+            ["Section 0", [["Section 1", [["Section 2", []]]]]],
+        )
+
+
+class PageSnapshotTest(TestCase):
+    factory = APIRequestFactory()
+
+    def setUp(self):
+        cache.clear()
+        self.page = Page.objects.create(title="Home")
+        section = Section.objects.create(title="Popular", slug="popular")
+        PageSection.objects.create(page=self.page, section=section, order=0)
+        self.data = Data.objects.create(
+            content_type=ContentType.objects.get_for_model(Product), filters={}
+        )
+        SectionData.objects.create(section=section, data=self.data)
+        self.product(0)
+
+    def product(self, i):
+        return Product.objects.create(
+            name=f"Product {i}", slug=f"product-{i}", price=100, sku=f"SKU-{i}"
+        )
+
+    def retrieve(self):
+        response = PageViewSet.as_view({"get": "retrieve"})(
+            self.factory.get("/"), pk=self.page.pk
+        )
+        response.render()
+        self.assertEqual(response.status_code, 200, response.content)
+        return response
+
+    def get_section_data(self):
+        return self.retrieve().data["page_sections"][0]["section_data"]
+
+    @override_settings(DATA_CACHE_TIMEOUT=0)
+    def test_section_data_is_not_snapshotted(self):
+        self.assertEqual(len(self.get_section_data()[0]), 1)
+
+        snapshot = cache.get(
+            f"page_snapshot:{self.page.pk}:{get_page_snapshot_version()}"
+        )
+        self.assertEqual(snapshot[0]["section_data"], [self.data.id])
+
+        # The cached snapshot is reused, the data expires on its own
+        self.product(1)
+        self.assertEqual(len(self.get_section_data()[0]), 2)
+
+    @override_settings(DATA_CACHE_TIMEOUT=60)
+    def test_etag_follows_data_cache_window(self):
+        etag = self.retrieve()["ETag"]
+        self.assertEqual(self.retrieve()["ETag"], etag)
+
+        # The data is cached per window, a new window is a new ETag
+        with mock.patch(
+            "timbrel.uicopy.models.time.time",
+            return_value=time.time() + 120,
+        ):
+            self.assertNotEqual(self.retrieve()["ETag"], etag)
+
+
+class CartTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="customer", password="customer", phone="254700000001"
+        )
+        self.a = Product.objects.create(name="A", price=100, sku="SKU-A")
+        self.b = Product.objects.create(name="B", price=50, sku="SKU-B")
+
+    def cart(self, operation, *items):
+        return OrderSerializer().cart(
+            {
+                "user": self.user,
+                "operation": operation,
+                "products": [
+                    {"product": product.id, "quantity": quantity}
+                    for product, quantity in items
+                ],
+            }
+        )
+
+    def get_quantities(self, order):
+        return dict(
+            order.order_products.order_by("product__name").values_list(
+                "product__name", "quantity"
+            )
+        )
+
+    def test_add(self):
+        order = self.cart("add", (self.a, 2), (self.b, 1))
+
+        self.assertEqual(order.order_status, "pending")
+        self.assertEqual(self.get_quantities(order), {"A": 2, "B": 1})
+        self.assertEqual(order.total_amount, 250)
+
+        # The same pending order is reused, repeated products are summed
+        self.assertEqual(self.cart("add", (self.a, 1), (self.a, 1)).pk, order.pk)
+        order.refresh_from_db()
+        self.assertEqual(self.get_quantities(order), {"A": 4, "B": 1})
+        self.assertEqual(order.total_amount, 450)
+
+    def test_add_increments_in_the_database(self):
+        order = self.cart("add", (self.a, 1))
+        # A write outside the cart, after the cart request read the line
+        OrderProduct.objects.filter(order=order).update(quantity=5)
+
+        self.cart("add", (self.a, 2))
+        self.assertEqual(self.get_quantities(order), {"A": 7})
+
+    def test_remove(self):
+        order = self.cart("add", (self.a, 3), (self.b, 1))
+
+        self.cart("remove", (self.a, 1))
+        self.assertEqual(self.get_quantities(order), {"A": 2, "B": 1})
+
+        # Lines at or below zero are deleted
+        order = self.cart("remove", (self.a, 5))
+        self.assertEqual(self.get_quantities(order), {"B": 1})
+        self.assertEqual(order.total_amount, 50)
+
+    def test_remove_without_order(self):
+        with self.assertRaises(ValidationError):
+            self.cart("remove", (self.a, 1))
+        self.assertFalse(Order.objects.exists())
+
+    def test_remove_missing_product(self):
+        self.cart("add", (self.a, 1))
+        with self.assertRaises(ValidationError):
+            self.cart("remove", (self.b, 1))
+
+    def test_concurrent_new_order(self):
+        # Another request creates the pending order between this request's
+        # lookup and its insert
+        existing = Order.objects.create(user=self.user)
+        with mock.patch.object(
+            OrderSerializer, "get_pending_order", side_effect=[None, existing]
+        ):
+            order = self.cart("add", (self.a, 1))
+
+        self.assertEqual(order.pk, existing.pk)
+        self.assertEqual(Order.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(self.get_quantities(order), {"A": 1})
+        self.assertEqual(order.total_amount, 100)
+
+
+class OrderPopularityTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(
+            username="customer", password="customer", phone="254700000001"
+        )
+        self.product = Product.objects.create(name="Product", price=100, sku="SKU")
+        self.order = Order.objects.create(user=user, total_amount=100)
+        OrderProduct.objects.create(order=self.order, product=self.product, price=100)
+
+    def get_order_count(self):
+        popularity = ProductPopularity.objects.filter(product=self.product).first()
+        return popularity.order_count if popularity else 0
+
+    def test_confirming_an_order_counts_once(self):
+        self.order.order_status = "confirmed"
+        self.order.save()
+        self.assertEqual(self.get_order_count(), 1)
+
+        self.order.save()
+        self.order.order_status = "shipped"
+        self.order.save()
+        self.assertEqual(self.get_order_count(), 1)
+
+    def test_stale_instance_does_not_count_twice(self):
+        stale = Order.objects.get(pk=self.order.pk)
+        self.order.order_status = "confirmed"
+        self.order.save()
+
+        stale.order_status = "confirmed"
+        stale.save()
+        self.assertEqual(self.get_order_count(), 1)
+
+
+class MpesaCallbackTest(TestCase):
+    """
+    Behaviour of MpesaCallback.handle, the callbacks Safaricom posts once an
+    STK push is paid or cancelled.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            username="customer",
+            email="customer@example.com",
+            password="customer",
+            phone="254700000001",
+        )
+        cls.product = Product.objects.create(
+            name="Product", slug="product", price=100, sku="SKU", stock_level=1
+        )
+
+    def setUp(self):
+        self.order = Order.objects.create(
+            user=self.user, order_status="processing", total_amount=100
+        )
+        OrderProduct.objects.create(
+            order=self.order, product=self.product, quantity=1, price=100
+        )
+        self.payment = Transaction.objects.create(
+            payment_method=PaymentMethod.objects.create(name="mpesa"),
+            amount=100,
+            user=self.user,
+            order=self.order,
+            reference="29115-34620561-1",
+            checkout_reference="ws_CO_191220191020363925",
+        )
+
+    def payload(self, merchant_request_id=None, checkout_request_id=None, code=0):
+        return {
+            "Body": {
+                "stkCallback": {
+                    "MerchantRequestID": merchant_request_id,
+                    "CheckoutRequestID": checkout_request_id,
+                    "ResultCode": code,
+                    "ResultDesc": "The service request is processed successfully.",
+                }
+            }
+        }
+
+    def test_success(self):
+        callback = MpesaCallback.handle(
+            self.payload(self.payment.reference, self.payment.checkout_reference)
+        )
+
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(callback.callback_status, "processed")
+        self.assertEqual(self.payment.transaction_status, "success")
+        self.assertEqual(self.order.order_status, "confirmed")
+        self.assertEqual(self.payment.history.first().transaction_status, "success")
+        self.assertEqual(self.order.history.first().order_status, "confirmed")
+        self.assertEqual(
+            ProductPopularity.objects.get(product=self.product).order_count, 1
+        )
+        # Only failed callbacks that match nothing are kept
+        self.assertFalse(MpesaCallback.objects.exists())
+
+    def test_failure_reverts_order(self):
+        MpesaCallback.handle(self.payload(self.payment.reference, code=1032))
+
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(self.payment.transaction_status, "failed")
+        self.assertEqual(self.order.order_status, "pending")
+        self.assertEqual(self.order.history.first().order_status, "pending")
+        self.assertFalse(ProductPopularity.objects.exists())
+
+    def test_duplicate_callbacks_are_noops(self):
+        payload = self.payload(self.payment.reference, self.payment.checkout_reference)
+        MpesaCallback.handle(payload)
+        transaction_history = self.payment.history.count()
+        order_history = self.order.history.count()
+
+        callback = MpesaCallback.handle(payload)
+        MpesaCallback.handle(self.payload(self.payment.reference, code=1032))
+
+        self.payment.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(callback.callback_status, "processed")
+        self.assertEqual(self.payment.transaction_status, "success")
+        self.assertEqual(self.order.order_status, "confirmed")
+        self.assertEqual(self.payment.history.count(), transaction_history)
+        self.assertEqual(self.order.history.count(), order_history)
+        self.assertEqual(
+            ProductPopularity.objects.get(product=self.product).order_count, 1
+        )
+
+    def test_duplicate_callbacks_in_one_batch(self):
+        payload = self.payload(self.payment.reference, self.payment.checkout_reference)
+        callbacks = MpesaCallback.process(
+            [MpesaCallback.from_payload(payload) for _ in range(3)]
+        )
+
+        self.assertEqual(
+            [callback.callback_status for callback in callbacks], ["processed"] * 3
+        )
+        self.assertEqual(
+            ProductPopularity.objects.get(product=self.product).order_count, 1
+        )
+
+    def test_checkout_request_id_only(self):
+        callback = MpesaCallback.handle(
+            self.payload(checkout_request_id=self.payment.checkout_reference)
+        )
+
+        self.payment.refresh_from_db()
+        self.assertEqual(callback.callback_status, "processed")
+        self.assertEqual(self.payment.transaction_status, "success")
+
+    def test_unmatched_callbacks_are_dead_lettered(self):
+        payload = self.payload("10000-00000000-1", "ws_CO_000000000000000000")
+        MpesaCallback.handle(payload)
+        callback = MpesaCallback.handle(payload)
+
+        self.payment.refresh_from_db()
+        self.assertEqual(callback.callback_status, "unmatched")
+        self.assertEqual(callback.payload, payload)
+        # Safaricom retries, a single dead letter is kept per request
+        self.assertEqual(
+            MpesaCallback.objects.filter(callback_status="unmatched").count(), 1
+        )
+        self.assertEqual(self.payment.transaction_status, "pending")
+
+    def test_malformed_callback_is_logged(self):
+        request = APIRequestFactory().post("/", {"Body": {}}, format="json")
+        with self.assertLogs("timbrel.payment.views", "WARNING"):
+            response = MpesaCallbackView.as_view()(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(MpesaCallback.objects.exists())
+
+    def test_sweep_drains_stale_and_prunes_processed_callbacks(self):
+        payload = self.payload(self.payment.reference, self.payment.checkout_reference)
+        long_ago = timezone.now() - datetime.timedelta(days=30)
+        # A queued callback whose drain was lost, an old processed one and an
+        # old dead letter
+        stale = MpesaCallback.from_payload(payload, callback_status="queued")
+        stale.save()
+        processed = MpesaCallback.from_payload(payload, callback_status="processed")
+        processed.save()
+        unmatched = MpesaCallback.from_payload(
+            self.payload("10000-00000000-1"), callback_status="unmatched"
+        )
+        unmatched.save()
+        MpesaCallback.objects.update(created_at=long_ago)
+
+        sweep_mpesa_callbacks()
+
+        self.payment.refresh_from_db()
+        self.assertEqual(self.payment.transaction_status, "success")
+        self.assertQuerySetEqual(
+            MpesaCallback.objects.order_by("callback_status").values_list(
+                "id", flat=True
+            ),
+            [unmatched.id],
+        )
+
+
+class StubMpesaHandler(BaseHTTPRequestHandler):
+    """
+    Daraja stand-in: GET issues numbered access tokens, POST is the STK push,
+    which rejects the tokens in `server.revoked`.
+    """
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.oauth_requests += 1
+            token = f"token-{self.server.oauth_requests}"
+        time.sleep(self.server.oauth_delay)
+        self.respond(200, {"access_token": token, "expires_in": self.server.expires_in})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        token = self.headers["Authorization"].removeprefix("Bearer ")
+        self.server.stk_tokens.append(token)
+        if token in self.server.revoked:
+            self.respond(
+                401, {"errorCode": "404.001.03", "errorMessage": "Invalid Access Token"}
+            )
+        else:
+            self.respond(
+                200,
+                {
+                    "MerchantRequestID": "29115-34620561-1",
+                    "CheckoutRequestID": "ws_CO_191220191020363925",
+                    "ResponseCode": "0",
+                },
+            )
+
+    def respond(self, status, body):
+        body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MpesaTokenTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), StubMpesaHandler)
+        cls.server.lock = threading.Lock()
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        self.server.oauth_requests = 0
+        self.server.oauth_delay = 0
+        self.server.expires_in = 3599
+        self.server.stk_tokens = []
+        self.server.revoked = set()
+
+        url = f"http://127.0.0.1:{self.server.server_port}"
+        settings = self.settings(
+            MPESA_OAUTH_ENDPOINT=f"{url}/oauth", MPESA_STK_ENDPOINT=f"{url}/stkpush"
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        cache.clear()
+        mpesa_token_cache.clear()
+
+    def token_cache(self):
+        return TokenCache("timbrel:test:token", request_mpesa_access_token)
+
+    def test_hits_and_misses(self):
+        token_cache = self.token_cache()
+
+        self.assertEqual(token_cache.get(), "token-1")
+        self.assertEqual(token_cache.get(), "token-1")
+        self.assertEqual(
+            token_cache.metrics, {"hits": 1, "misses": 1, "refreshes": 1, "errors": 0}
+        )
+        # Another worker reads the token from the shared cache
+        self.assertEqual(self.token_cache().get(), "token-1")
+        self.assertEqual(self.server.oauth_requests, 1)
+
+    def test_refreshes_before_expiry(self):
+        self.server.expires_in = 120
+        token_cache = self.token_cache()
+        token_cache.get()
+        now = time.time()
+
+        with mock.patch("time.time", return_value=now + 59):
+            self.assertEqual(token_cache.get(), "token-1")
+        # Within the 60 second refresh margin of expires_in
+        with mock.patch("time.time", return_value=now + 61):
+            self.assertEqual(token_cache.get(), "token-2")
+
+    def test_single_flight_refresh(self):
+        self.server.oauth_delay = 0.3
+        # One cache per worker, sharing the Django cache
+        token_caches = [self.token_cache() for _ in range(4)]
+        tokens = []
+
+        def get(token_cache):
+            tokens.append(token_cache.get())
+
+        threads = [
+            threading.Thread(target=get, args=(token_cache,))
+            for token_cache in token_caches
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(tokens, ["token-1"] * 16)
+        self.assertEqual(self.server.oauth_requests, 1)
+
+    def test_revoked_token_is_refreshed_once(self):
+        mpesa_token_cache.set("revoked", 3599)
+        self.server.revoked = {"revoked"}
+
+        response = mpesa_express(1, "254700000000", "ORD-1", "Order Payment")
+
+        self.assertEqual(response["MerchantRequestID"], "29115-34620561-1")
+        self.assertEqual(self.server.stk_tokens, ["revoked", "token-1"])
+        self.assertEqual(mpesa_token_cache.get(), "token-1")
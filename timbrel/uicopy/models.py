@@ -1,8 +1,16 @@
+import time
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
 from django.db import models
+from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType
 
 
-from timbrel.base import BaseModel
+from timbrel.base import BaseModel, get_with_lookups
+
+PAGE_SNAPSHOT_VERSION_KEY = "timbrel:page_snapshot:version"
 
 
 class Text(BaseModel):
@@ -134,3 +142,184 @@ class PageSection(BaseModel):
 class SectionData(BaseModel):
     section = models.ForeignKey(Section, on_delete=models.CASCADE)
     data = models.ForeignKey(Data, on_delete=models.CASCADE, null=True, blank=True)
+
+
+class SectionTree:
+    """
+    The sections below `root_ids`, at most `max_depth` levels deep, with
+    their texts, buttons, images and data. Child links are read with one
+    query per level, for the sections reached so far only, and walked in
+    memory, dropping any link back to an ancestor so that cyclic sections
+    cannot recurse forever.
+    The rows are loaded with one query per through table, instead of a set of
+    queries per section. Only the section relationships requested in `withs`
+    are prefetched, the serializers do not read the others.
+    """
+
+    def __init__(self, root_ids, max_depth=None, withs=()):
+        self.root_ids = list(root_ids)
+        self.max_depth = (
+            max_depth
+            if max_depth is not None
+            else getattr(settings, "SECTION_MAX_DEPTH", 5)
+        )
+
+        self.edges = defaultdict(list)
+        section_ids = set(self.root_ids)
+        frontier = set(self.root_ids)
+        for _ in range(self.max_depth):
+            for parent_id, child_id in (
+                SectionSection.objects.filter(parent_id__in=frontier)
+                .order_by("order")
+                .values_list("parent_id", "child_id")
+            ):
+                self.edges[parent_id].append(child_id)
+
+            frontier = {
+                child_id
+                for parent_id in frontier
+                for child_id in self.edges[parent_id]
+                if child_id not in section_ids
+            }
+            if not frontier:
+                break
+            section_ids |= frontier
+
+        select_lookups, prefetch_lookups = get_with_lookups(Section, withs)
+        self.sections = {
+            section.id: section
+            for section in Section.objects.filter(id__in=section_ids)
+            .select_related(*select_lookups)
+            .prefetch_related(*prefetch_lookups)
+        }
+
+        self.texts = self.group(
+            SectionText.objects.filter(section_id__in=section_ids)
+            .select_related("text")
+            .order_by("order"),
+            "text",
+        )
+        self.buttons = self.group(
+            SectionButton.objects.filter(section_id__in=section_ids)
+            .select_related("button__text")
+            .order_by("order"),
+            "button",
+        )
+        self.images = self.group(
+            SectionImage.objects.filter(section_id__in=section_ids)
+            .select_related("image")
+            .order_by("order"),
+            "image",
+        )
+        self.data = self.group(
+            SectionData.objects.filter(section_id__in=section_ids)
+            .select_related("data")
+            .order_by("-data__created_at"),
+            "data",
+        )
+
+    @classmethod
+    def for_page(cls, page):
+        return cls(
+            PageSection.objects.filter(page=page)
+            .order_by("order")
+            .values_list("section_id", flat=True)
+        )
+
+    @staticmethod
+    def group(rows, field_name):
+        grouped = defaultdict(list)
+        for row in rows:
+            related = getattr(row, field_name)
+            if related is not None:
+                grouped[row.section_id].append(related)
+        return grouped
+
+    def __contains__(self, section_id):
+        return section_id in self.sections
+
+    @property
+    def roots(self):
+        return self.get_sections(self.root_ids)
+
+    def get_children(self, path):
+        """
+        Returns the children of the last section of `path`, the ids from a
+        root down to it, leaving out its ancestors and anything deeper than
+        `max_depth`.
+        """
+        if len(path) > self.max_depth:
+            return []
+        return self.get_sections(
+            child_id for child_id in self.edges[path[-1]] if child_id not in path
+        )
+
+    def get_sections(self, section_ids):
+        return [
+            self.sections[section_id]
+            for section_id in section_ids
+            if section_id in self.sections
+        ]
+
+
+def get_page_snapshot_version():
+    version = cache.get(PAGE_SNAPSHOT_VERSION_KEY)
+    if version is None:
+        cache.add(PAGE_SNAPSHOT_VERSION_KEY, uuid.uuid4().hex, None)
+        version = cache.get(PAGE_SNAPSHOT_VERSION_KEY)
+    return version
+
+
+def has_section_data():
+    """
+    Whether any section shows data, cached until the next section change.
+    """
+    key = f"timbrel:page_snapshot:has_data:{get_page_snapshot_version()}"
+    has_data = cache.get(key)
+    if has_data is None:
+        has_data = SectionData.objects.filter(data__isnull=False).exists()
+        cache.set(key, has_data, getattr(settings, "PAGE_SNAPSHOT_TIMEOUT", 60 * 60))
+    return has_data
+
+
+def get_data_cache_window():
+    """
+    Returns the current DATA_CACHE_TIMEOUT window. Section data is cached per
+    window, so a response and its ETag always describe the same window.
+    """
+    timeout = getattr(settings, "DATA_CACHE_TIMEOUT", 60)
+    if timeout <= 0:
+        return uuid.uuid4().hex
+    return int(time.time() // timeout)
+
+
+def get_section_data_version():
+    """
+    Returns the data cache window while any section shows data, else None so
+    that pages without data keep the same ETag.
+    """
+    return get_data_cache_window() if has_section_data() else None
+
+
+def invalidate_page_snapshots(sender, **kwargs):
+    """
+    Signal receiver, expires every cached page snapshot after a change to
+    the sections or their content.
+    """
+    if issubclass(
+        sender,
+        (
+            Section,
+            SectionSection,
+            SectionText,
+            SectionButton,
+            SectionImage,
+            SectionData,
+            PageSection,
+            Text,
+            Button,
+            Image,
+            Data,
+        ),
+    ):
+        cache.set(PAGE_SNAPSHOT_VERSION_KEY, uuid.uuid4().hex, None)
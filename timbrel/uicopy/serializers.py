@@ -1,11 +1,30 @@
-from django.core.exceptions import ObjectDoesNotExist
+import hashlib
+import json
+import logging
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import FieldDoesNotExist, ObjectDoesNotExist
 from django.contrib.contenttypes.models import ContentType
+from django.db import models
 from rest_framework import serializers
 
 from timbrel.base import BaseSerializer
-from timbrel.utils import get_serializer_dict
+from timbrel.utils import get_filterset_class, serializer_registry
+
+from .models import (
+    Page,
+    Section,
+    Text,
+    Button,
+    Image,
+    Data,
+    SectionTree,
+    get_data_cache_window,
+    get_page_snapshot_version,
+)
 
-from .models import Page, Section, Text, Button, Image, Data
+logger = logging.getLogger(__name__)
 
 
 class TextSerializer(BaseSerializer):
@@ -44,26 +63,32 @@ class DataSerializer(BaseSerializer):
 
     def to_representation(self, instance):
         try:
-            content_type = ContentType.objects.get(id=instance.content_type_id)
+            content_type = ContentType.objects.get_for_id(instance.content_type_id)
             model_class = content_type.model_class()
 
             if model_class is None:
                 raise ValueError("No model found for this content type.")
 
-            # get all the filters from instance.filters
-            # check if there is a page_size filter
-
-            if "page_size" in instance.filters:
-                print("PAGE SIZE IN FILTERS", content_type.model)
-                page_size = int(instance.filters["page_size"])
-                queryset = model_class.objects.all()[:page_size]
-            else:
-                print("PAGE SIZE NOT FOUND IN FILTERS", content_type.model)
-                queryset = model_class.objects.all()
-
-            serializer_dict = get_serializer_dict()
-            serializer_class = serializer_dict.get(content_type.model)
-            serialized_data = serializer_class(queryset, many=True).data
+            serializer_class = serializer_registry.get(content_type.model)
+            if serializer_class is None:
+                raise ValueError(f"No serializer found for {content_type.model}.")
+
+            filters = instance.filters or {}
+            key = "section_data:{}:{}:{}".format(
+                instance.id,
+                get_data_cache_window(),
+                hashlib.sha1(
+                    json.dumps(filters, sort_keys=True, default=str).encode()
+                ).hexdigest(),
+            )
+            serialized_data = cache.get(key)
+            if serialized_data is None:
+                serialized_data = serializer_class(
+                    self.get_queryset(model_class, filters), many=True
+                ).data
+                cache.set(
+                    key, serialized_data, getattr(settings, "DATA_CACHE_TIMEOUT", 60)
+                )
 
             return serialized_data
 
@@ -73,6 +98,65 @@ class DataSerializer(BaseSerializer):
             print(f"An error occurred: {e}")
         return super().to_representation(instance)
 
+    def get_queryset(self, model_class, filters):
+        """
+        Compiles the stored filters into the model's queryset: the model's
+        FilterSet fields, an `ordering` of comma separated fields, and a
+        `page_size` capped at DATA_MAX_ROWS. Invalid filters return no rows.
+        """
+        queryset = model_class.objects.all()
+
+        filterset_class = get_filterset_class(model_class)
+        if filterset_class is not None:
+            filterset = filterset_class(data=filters, queryset=queryset)
+            if not filterset.is_valid():
+                # Unfiltered rows could expose far more than the section meant to
+                logger.warning(
+                    "Invalid filters for %s: %s",
+                    model_class._meta.label,
+                    filterset.errors.as_json(),
+                )
+                return queryset.none()
+            queryset = filterset.qs
+
+        ordering = [
+            field
+            for field in str(filters.get("ordering", "")).split(",")
+            if field and self.is_model_field(model_class, field.lstrip("-"))
+        ]
+        if ordering:
+            queryset = queryset.order_by(*ordering)
+
+        max_rows = getattr(settings, "DATA_MAX_ROWS", 100)
+        try:
+            page_size = min(int(filters.get("page_size", max_rows)), max_rows)
+        except (TypeError, ValueError):
+            page_size = max_rows
+        return queryset[: max(page_size, 0)]
+
+    def is_model_field(self, model_class, field_name):
+        try:
+            model_class._meta.get_field(field_name)
+        except FieldDoesNotExist:
+            return False
+        return True
+
+
+class SectionListSerializer(serializers.ListSerializer):
+    """
+    Loads one SectionTree for all the listed sections, unless the context
+    already holds a tree with them.
+    """
+
+    def to_representation(self, data):
+        sections = list(data.all() if isinstance(data, models.Manager) else data)
+        tree = self.child.get_section_tree()
+        if sections and not (tree and all(section.id in tree for section in sections)):
+            self.child.context["section_tree"] = SectionTree(
+                [section.id for section in sections], withs=self.child.get_withs()
+            )
+        return super().to_representation(sections)
+
 
 class SectionSerializer(BaseSerializer):
     section_texts = serializers.SerializerMethodField()
@@ -81,31 +165,55 @@ class SectionSerializer(BaseSerializer):
     child_sections = serializers.SerializerMethodField()
     section_data = serializers.SerializerMethodField()
 
+    def to_representation(self, instance):
+        tree = self.get_section_tree()
+        if not (tree and instance.id in tree):
+            # Load the section's whole subtree at once, for sections
+            # serialized on their own
+            self.context["section_tree"] = SectionTree(
+                [instance.id], withs=self.get_withs()
+            )
+        return super().to_representation(instance)
+
+    def get_section_tree(self):
+        """
+        Returns the SectionTree of the serialized sections, whose preloaded
+        rows are used instead of querying each section.
+        """
+        return self.context.get("section_tree")
+
     def get_section_texts(self, obj):
-        return TextSerializer(obj.texts.order_by("sectiontext__order"), many=True).data
+        return TextSerializer(self.get_section_tree().texts[obj.id], many=True).data
 
     def get_section_buttons(self, obj):
         return ButtonSerializer(
-            obj.buttons.order_by("sectionbutton__order"), many=True
+            self.get_section_tree().buttons[obj.id], many=True
         ).data
 
     def get_section_images(self, obj):
-        return ImageSerializer(
-            obj.images.order_by("sectionimage__order"), many=True
-        ).data
+        return ImageSerializer(self.get_section_tree().images[obj.id], many=True).data
 
     def get_child_sections(self, obj):
+        tree = self.get_section_tree()
+        path = self.context.get("section_path", ()) + (obj.id,)
         serializer = SectionSerializer(
-            obj.children.order_by("child_sections__order"), many=True
+            tree.get_children(path),
+            many=True,
+            context={**self.context, "section_path": path},
         )
         return serializer.data
 
     def get_section_data(self, obj):
-        return DataSerializer(obj.data, many=True).data
+        data = self.get_section_tree().data[obj.id]
+        if self.context.get("defer_section_data"):
+            # Only the ids, the data is filled in per request
+            return [row.id for row in data]
+        return DataSerializer(data, many=True).data
 
     class Meta:
         model = Section
         fields = "__all__"
+        list_serializer_class = SectionListSerializer
 
 
 class PageSerializer(BaseSerializer):
@@ -113,9 +221,64 @@ class PageSerializer(BaseSerializer):
     # page_images = serializers.SerializerMethodField()
 
     def get_page_sections(self, obj):
-        return SectionSerializer(
-            obj.sections.order_by("pagesection__order"), many=True
-        ).data
+        """
+        Returns the page's serialized section tree, compiled once and cached
+        until a section or its content changes. The section data is left out
+        of the snapshot and filled in on every request, so that it expires
+        with DATA_CACHE_TIMEOUT rather than with the snapshot.
+        """
+        key = f"page_snapshot:{obj.pk}:{get_page_snapshot_version()}"
+        page_sections = cache.get(key)
+        if page_sections is None:
+            tree = SectionTree.for_page(obj)
+            page_sections = SectionSerializer(
+                tree.roots,
+                many=True,
+                context={"section_tree": tree, "defer_section_data": True},
+            ).data
+            cache.set(
+                key,
+                page_sections,
+                getattr(settings, "PAGE_SNAPSHOT_TIMEOUT", 60 * 60),
+            )
+        return self.fill_section_data(page_sections)
+
+    def fill_section_data(self, page_sections):
+        """
+        Replaces the data ids of the snapshot sections with their data, read
+        with one query and serialized through the DataSerializer cache.
+        """
+        data_ids = set()
+        self.walk_sections(
+            page_sections, lambda section: data_ids.update(section["section_data"])
+        )
+        if not data_ids:
+            return page_sections
+
+        data = Data.objects.in_bulk(data_ids)
+        serialized = dict(
+            zip(data.keys(), DataSerializer(data.values(), many=True).data)
+        )
+
+        def fill(section):
+            section_data = [
+                serialized[data_id]
+                for data_id in section["section_data"]
+                if data_id in serialized
+            ]
+            if section_data:
+                section["section_data"] = section_data
+            else:
+                section.pop("section_data")
+
+        self.walk_sections(page_sections, fill)
+        return page_sections
+
+    def walk_sections(self, sections, visit):
+        for section in sections:
+            if "section_data" in section:
+                visit(section)
+            self.walk_sections(section.get("child_sections", []), visit)
 
     class Meta:
         model = Page
@@ -8,7 +8,14 @@ from .serializers import (
     SectionSerializer,
     PageSerializer,
 )
-from .models import Text, Data, Section, Page
+from .models import (
+    Text,
+    Data,
+    Section,
+    Page,
+    get_page_snapshot_version,
+    get_section_data_version,
+)
 
 
 class TextViewSet(BaseViewSet):
@@ -22,6 +29,8 @@ class DataViewSet(BaseViewSet):
     queryset = Data.objects.all()
     serializer_class = DataSerializer
     permission_classes = [permissions.DjangoModelPermissionsOrAnonReadOnly]
+    # The response is the data of other tables, not of the Data rows
+    conditional_actions = []
 
 
 class SectionViewSet(BaseViewSet):
@@ -30,9 +39,24 @@ class SectionViewSet(BaseViewSet):
     permission_classes = [permissions.DjangoModelPermissionsOrAnonReadOnly]
     search_fields = ["title", "description", "slug"]
 
+    def get_etag_parts(self):
+        # Changes to the texts, buttons, images and children do not touch the section
+        return super().get_etag_parts() + [
+            get_page_snapshot_version(),
+            get_section_data_version(),
+        ]
+
 
 class PageViewSet(BaseViewSet):
     queryset = Page.objects.all()
     serializer_class = PageSerializer
     permission_classes = [permissions.DjangoModelPermissionsOrAnonReadOnly]
     search_fields = ["email", "phone", "username", "slug"]
+
+    def get_etag_parts(self):
+        # Section changes do not touch the page, the section data is cached
+        # per DATA_CACHE_TIMEOUT window
+        return super().get_etag_parts() + [
+            get_page_snapshot_version(),
+            get_section_data_version(),
+        ]
@@ -3,11 +3,14 @@ import random
 import string
 import inflect
 import base64
-import requests
+import functools
 import importlib
+import threading
+import time
 from datetime import datetime
 
 from django.apps import apps
+from django.core.cache import cache
 from django.contrib.contenttypes.models import ContentType
 from django.core.exceptions import FieldDoesNotExist
 from django.db.models import ForeignKey, OneToOneField, ManyToManyField
@@ -16,6 +19,7 @@ from django.conf import settings
 from rest_framework import viewsets, serializers, routers
 
 from .settings import modules
+from .httpclient import http_client
 
 p = inflect.engine()
 
@@ -90,27 +94,71 @@ def get_route_prefix(app_name):
     return f"{prefix}/" if prefix else ""
 
 
+class SerializerRegistry:
+    """
+    Process-wide, lazily built map of model name -> serializer class.
+    Scanning every `<app>.serializers` module is expensive, so the map is built
+    once and reused until `clear` is called (autoreload, app registry or
+    MY_APPS changes).
+    """
+
+    def __init__(self):
+        self._serializers = None
+        self._lock = threading.Lock()
+        self.build_count = 0
+
+    def _build(self):
+        serializer_dict = {}
+        for app in settings.MY_APPS:
+            try:
+                serializers_module = __import__(f"{app}.serializers", fromlist=[""])
+
+                # Iterate over all members (classes, functions, etc.) in the serializers module
+                for name, obj in inspect.getmembers(serializers_module):
+                    if (
+                        inspect.isclass(obj)
+                        and issubclass(obj, serializers.ModelSerializer)
+                        and name != "BaseSerializer"
+                    ):
+                        serializer_name = obj.__name__
+                        serializer_name_lower = serializer_name.lower()
+                        base_name = serializer_name_lower.replace("serializer", "")
+                        serializer_dict[base_name] = obj
+            except ModuleNotFoundError:
+                pass
+
+        return serializer_dict
+
+    def all(self):
+        serializer_dict = self._serializers
+        if serializer_dict is None:
+            with self._lock:
+                serializer_dict = self._serializers
+                if serializer_dict is None:
+                    serializer_dict = self._build()
+                    self._serializers = serializer_dict
+                    self.build_count += 1
+        return serializer_dict
+
+    def get(self, name, default=None):
+        return self.all().get(name, default)
+
+    def clear(self, **kwargs):
+        with self._lock:
+            self._serializers = None
+
+
+serializer_registry = SerializerRegistry()
+
+
 def get_serializer_dict():
-    serializer_dict = {}
-    for app in settings.MY_APPS:
-        try:
-            viewsets_module = __import__(f"{app}.serializers", fromlist=[""])
-
-            # Iterate over all members (classes, functions, etc.) in the serializers module
-            for name, obj in inspect.getmembers(viewsets_module):
-                if (
-                    inspect.isclass(obj)
-                    and issubclass(obj, serializers.ModelSerializer)
-                    and name != "BaseSerializer"
-                ):
-                    serializer_name = obj.__name__
-                    serializer_name_lower = serializer_name.lower()
-                    base_name = serializer_name_lower.replace("serializer", "")
-                    serializer_dict[base_name] = obj
-        except ModuleNotFoundError:
-            pass
+    return serializer_registry.all()
 
-    return serializer_dict
+
+def clear_serializer_registry(sender=None, setting=None, **kwargs):
+    """Signal receiver, ignores settings that cannot change the registry."""
+    if setting in (None, "MY_APPS", "INSTALLED_APPS"):
+        serializer_registry.clear()
 
 
 def is_relationship(model, field_name):
@@ -152,8 +200,11 @@ def encode_data(key, secret, timestamp="", separator=""):
     return encoded_data.decode("utf-8")
 
 
+# Daraja's error code for a revoked or expired access token
+MPESA_INVALID_TOKEN_ERROR = "404.001.03"
+
+
 def mpesa_express(amount, phone, reference, description):
-    access_token = authenticate()
     timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
     password = encode_data(
         key=settings.MPESA_SHORTCODE,
@@ -161,10 +212,6 @@ def mpesa_express(amount, phone, reference, description):
         timestamp=timestamp,
     )
 
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-    }
-
     test_phones = settings.TEST_PHONES.split(",")
     if phone in test_phones:
         amount = 1
@@ -183,30 +230,174 @@ def mpesa_express(amount, phone, reference, description):
         "TransactionDesc": description,
     }
 
-    response = requests.post(
-        url=settings.MPESA_STK_ENDPOINT,
-        headers=headers,
+    response = post_mpesa_express(payload)
+    if is_mpesa_token_rejected(response):
+        # The cached token was revoked before it expired, a rejected push was
+        # not processed so it is safe to send it again with a new token
+        mpesa_token_cache.clear()
+        response = post_mpesa_express(payload)
+
+    return response.json()
+
+
+def post_mpesa_express(payload):
+    return http_client.post(
+        settings.MPESA_STK_ENDPOINT,
+        headers={"Authorization": f"Bearer {authenticate()}"},
         json=payload,
     )
 
-    return response.json()
 
+def is_mpesa_token_rejected(response):
+    if response.status_code == 401:
+        return True
+    try:
+        return response.json().get("errorCode") == MPESA_INVALID_TOKEN_ERROR
+    except ValueError:
+        return False
 
-def authenticate():
+
+class TokenCache:
+    """
+    Caches an access token in the Django cache, shared by all workers, with an
+    in-process copy in front of it that is also used when the cache backend
+    is unavailable. The token is refreshed `refresh_margin` seconds before it
+    expires, and only one caller refreshes it at a time.
+    """
+
+    def __init__(self, key, fetch, refresh_margin=60, lock_timeout=10):
+        self.key = key
+        self.lock_key = f"{key}:lock"
+        self.fetch = fetch
+        self.refresh_margin = refresh_margin
+        self.lock_timeout = lock_timeout
+        self._token = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+        self.metrics = {"hits": 0, "misses": 0, "refreshes": 0, "errors": 0}
+
+    def get(self):
+        token = self._get_cached()
+        if token:
+            self.metrics["hits"] += 1
+            return token
+
+        self.metrics["misses"] += 1
+
+        with self._lock:
+            # Another thread may have refreshed the token while we waited
+            token = self._get_cached()
+            if token:
+                return token
+
+            locked = self._acquire_lock()
+            if not locked:
+                token = self._wait_for_refresh()
+                if token:
+                    return token
+
+            try:
+                token, expires_in = self.fetch()
+                self.metrics["refreshes"] += 1
+                self.set(token, expires_in)
+            finally:
+                if locked:
+                    self._release_lock()
+
+        return token
+
+    def set(self, token, expires_in):
+        expires_at = time.time() + int(expires_in) - self.refresh_margin
+        self._token = token
+        self._expires_at = expires_at
+
+        try:
+            cache.set(
+                self.key,
+                {"token": token, "expires_at": expires_at},
+                max(int(expires_at - time.time()), 1),
+            )
+        except Exception:
+            self.metrics["errors"] += 1
+
+    def clear(self):
+        self._token = None
+        self._expires_at = 0
+
+        try:
+            cache.delete(self.key)
+        except Exception:
+            self.metrics["errors"] += 1
+
+    def _get_cached(self):
+        if self._token and self._expires_at > time.time():
+            return self._token
+
+        try:
+            cached = cache.get(self.key)
+        except Exception:
+            self.metrics["errors"] += 1
+            return None
+
+        if cached and cached["expires_at"] > time.time():
+            self._token = cached["token"]
+            self._expires_at = cached["expires_at"]
+            return self._token
+
+        return None
+
+    def _acquire_lock(self):
+        try:
+            return cache.add(self.lock_key, True, self.lock_timeout)
+        except Exception:
+            self.metrics["errors"] += 1
+            return True
+
+    def _release_lock(self):
+        try:
+            cache.delete(self.lock_key)
+        except Exception:
+            self.metrics["errors"] += 1
+
+    def _wait_for_refresh(self):
+        """
+        Waits for the worker holding the refresh lock to cache a new token,
+        returns None if it does not do so within `lock_timeout`.
+        """
+        deadline = time.time() + self.lock_timeout
+        while time.time() < deadline:
+            time.sleep(0.1)
+            token = self._get_cached()
+            if token:
+                return token
+        return None
+
+
+def request_mpesa_access_token():
     base64_string = encode_data(
         key=settings.MPESA_CONSUMER_KEY,
         secret=settings.MPESA_CONSUMER_SECRET,
         separator=":",
     )
 
-    response = requests.request(
-        "GET",
+    response = http_client.get(
         settings.MPESA_OAUTH_ENDPOINT,
         headers={"Authorization": f"Basic {base64_string}"},
     )
 
     json_response = response.json()
-    return json_response["access_token"]
+    return json_response["access_token"], json_response.get("expires_in", 3599)
+
+
+mpesa_token_cache = TokenCache(
+    "timbrel:mpesa:access_token",
+    request_mpesa_access_token,
+    refresh_margin=getattr(settings, "MPESA_TOKEN_REFRESH_MARGIN", 60),
+)
+
+
+def authenticate():
+    return mpesa_token_cache.get()
 
 
 def get_class(_class):
@@ -242,6 +433,21 @@ def get_classes(name):
     return classes
 
 
+@functools.lru_cache(maxsize=None)
+def get_filterset_class(model):
+    """
+    Returns the FilterSet the model's viewset filters with, from its
+    `filterset_class` or `filterset_fields`, or None.
+    """
+    from django_filters.rest_framework import DjangoFilterBackend
+
+    for viewset in import_classes(prepare_modules("views")).values():
+        queryset = getattr(viewset, "queryset", None)
+        if queryset is not None and queryset.model is model:
+            return DjangoFilterBackend().get_filterset_class(viewset, queryset)
+    return None
+
+
 def only(request, *args):
     return dict(filter(lambda item: item[0] in args, request.items()))
 